@@ -1,2 +1,11 @@
 __version__ = "0.0.6"
-from .core import *
\ No newline at end of file
+from .base import *
+
+def __getattr__(name):
+    # the fastai integration in `fastsparse.core` is only imported when one of its names is used
+    if name.startswith('__') and name != '__all__': raise AttributeError(name)
+    import importlib
+    core = importlib.import_module(f'{__name__}.core')
+    if name == '__all__': return core.__all__
+    try: return getattr(core, name)
+    except AttributeError: raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
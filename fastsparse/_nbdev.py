@@ -6,15 +6,29 @@ index = {"sparse_mask": "00_core.ipynb",
          "sparse_mask_like": "00_core.ipynb",
          "mask_from_tensor": "00_core.ipynb",
          "sparsity_from_tensor": "00_core.ipynb",
+         "mask_generator": "00_core.ipynb",
+         "pack_mask": "00_core.ipynb",
+         "unpack_mask": "00_core.ipynb",
+         "to_blocks": "00_core.ipynb",
+         "from_blocks": "00_core.ipynb",
+         "to_groups": "00_core.ipynb",
+         "from_groups": "00_core.ipynb",
+         "structured_sparse_mask": "00_core.ipynb",
          "maybe_float": "00_core.ipynb",
          "sparse_params": "00_core.ipynb",
+         "cached_sparse_params": "00_core.ipynb",
+         "clear_sparse_params_cache": "00_core.ipynb",
          "apply_masks": "00_core.ipynb",
+         "apply_masks_fused": "00_core.ipynb",
          "is_sparseable_module": "00_core.ipynb",
          "sparseable_modules": "00_core.ipynb",
          "init_kaiming_normal_sparse_": "00_core.ipynb",
          "uniform_sparsity": "00_core.ipynb",
          "first_layer_dense_uniform": "00_core.ipynb",
          "erdos_renyi_sparsity": "00_core.ipynb",
+         "ApplyMasksCallback": "00_core.ipynb",
+         "apply_masks_after_step": "00_core.ipynb",
+         "broadcast_masks": "00_core.ipynb",
          "sparsify_model": "00_core.ipynb",
          "random_score": "00_core.ipynb",
          "weight_magnitude": "00_core.ipynb",
@@ -26,12 +40,55 @@ index = {"sparse_mask": "00_core.ipynb",
          "SET_presets": "00_core.ipynb",
          "SNFS_presets": "00_core.ipynb",
          "RigL_presets": "00_core.ipynb",
+         "DynamicSparseTrainingOptimizerWrapper": "00_core.ipynb",
+         "CompactOptimizerState": "00_core.ipynb",
+         "CompactOptimizerStateCallback": "00_core.ipynb",
+         "SparseWeightGrad": "00_core.ipynb",
+         "module_flops": "00_core.ipynb",
+         "mask_density": "00_core.ipynb",
          "flop_counter_hook": "00_core.ipynb",
          "sparse_flop_counter_hook": "00_core.ipynb",
+         "backward_flop_counter_hook": "00_core.ipynb",
+         "flop_modules": "00_core.ipynb",
          "count_flops": "00_core.ipynb",
-         "FlopsCounter": "00_core.ipynb"}
+         "param_flops": "00_core.ipynb",
+         "flop_budget_sparsity": "00_core.ipynb",
+         "FlopsCounter": "00_core.ipynb",
+         "save_sparse_model": "01_checkpoint.ipynb",
+         "load_sparse_model": "01_checkpoint.ipynb",
+         "MaskHistoryWriter": "01_checkpoint.ipynb",
+         "MaskHistory": "01_checkpoint.ipynb",
+         "SparseLinear": "02_inference.ipynb",
+         "SparseConv2d": "02_inference.ipynb",
+         "to_sparse_inference": "02_inference.ipynb",
+         "compact_model": "02_inference.ipynb",
+         "synthetic_model": "03_benchmark.ipynb",
+         "PeakMemory": "03_benchmark.ipynb",
+         "measure": "03_benchmark.ipynb",
+         "bench_sparsify_model": "03_benchmark.ipynb",
+         "bench_apply_masks": "03_benchmark.ipynb",
+         "bench_forward": "03_benchmark.ipynb",
+         "bench_backward": "03_benchmark.ipynb",
+         "bench_top_k_mask": "03_benchmark.ipynb",
+         "bench_rewire_module": "03_benchmark.ipynb",
+         "bench_rewire_workers": "03_benchmark.ipynb",
+         "bench_momentum_redistribution": "03_benchmark.ipynb",
+         "bench_erdos_renyi_sparsity": "03_benchmark.ipynb",
+         "benchmarks": "03_benchmark.ipynb",
+         "import_time": "03_benchmark.ipynb",
+         "bench_import": "03_benchmark.ipynb",
+         "run_benchmarks": "03_benchmark.ipynb",
+         "save_benchmarks": "03_benchmark.ipynb",
+         "load_benchmarks": "03_benchmark.ipynb",
+         "compare_benchmarks": "03_benchmark.ipynb",
+         "benchmark_cli": "03_benchmark.ipynb",
+         "compare_cli": "03_benchmark.ipynb"}
 
-modules = ["core.py"]
+modules = ["base.py",
+           "core.py",
+           "checkpoint.py",
+           "inference.py",
+           "benchmark.py"]
 
 doc_url = "https://dcato98.github.io/fastsparse/"
 
@@ -0,0 +1,1389 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 00_base.ipynb (unless otherwise specified).
+
+__all__ = ['sparse_mask', 'sparse_mask_like', 'mask_from_tensor', 'sparsity_from_tensor', 'mask_generator', 'pack_mask',
+           'unpack_mask', 'to_blocks', 'from_blocks', 'to_groups', 'from_groups', 'structured_sparse_mask',
+           'maybe_float', 'sparse_params', 'cached_sparse_params', 'clear_sparse_params_cache', 'apply_masks',
+           'apply_masks_fused', 'is_sparseable_module', 'sparseable_modules', 'init_kaiming_normal_sparse_',
+           'uniform_sparsity', 'first_layer_dense_uniform', 'erdos_renyi_sparsity', 'broadcast_masks', 'random_score',
+           'weight_magnitude', 'gradient_magnitude', 'gradient_momentum', 'momentum_redistribution', 'top_k_mask',
+           'SET_presets', 'SNFS_presets', 'RigL_presets', 'DynamicSparseTrainingOptimizerWrapper',
+           'CompactOptimizerState', 'SparseWeightGrad', 'module_flops', 'mask_density', 'flop_counter_hook',
+           'sparse_flop_counter_hook', 'backward_flop_counter_hook', 'flop_modules', 'count_flops', 'param_flops',
+           'flop_budget_sparsity']
+
+# Cell
+import re
+import math
+import inspect
+import time
+import warnings
+import weakref
+import zlib
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from torch import Tensor
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def sparse_mask(sizes, sparsity, device=None, generator=None):
+    '''
+    Returns a boolean mask with uniformly distributed zeros. # zeros = `sparsity` * np.prod(`sizes`)
+
+    The mask is created on `device` (default: the device of `generator`, or the CPU) by sampling the positions of
+    the ones (or of the zeros, whichever are fewer) with `generator`, in O(# ones) random numbers and memory besides
+    the mask itself.
+    '''
+    n_total = int(np.prod(sizes))
+    n_ones = round((1-sparsity) * n_total)
+    device = _mask_device(device, generator)
+    fill = n_ones > n_total // 2
+    n_sample = n_total - n_ones if fill else n_ones
+    mask = torch.full((n_total,), fill, dtype=torch.bool, device=device)
+    while n_sample > 0:
+        # draw as many positions as are missing, dropping duplicates and positions that are already set
+        idx = torch.randint(n_total, (n_sample,), device=device, generator=generator).unique()
+        idx = idx[mask[idx] == fill]
+        mask[idx] = not fill
+        n_sample -= idx.numel()
+    return mask.reshape(*sizes)
+
+def _mask_device(device, generator):
+    return torch.device(device) if device is not None else generator.device if generator is not None else torch.device('cpu')
+
+def sparse_mask_like(param, sparsity, generator=None): return sparse_mask(param.shape, sparsity, param.device, generator)
+def mask_from_tensor(t): return t.ne(0)
+def sparsity_from_tensor(t): return 1 - mask_from_tensor(t).sum() / t.numel()
+
+# Comes from 00_core.ipynb, cell
+def mask_generator(seed, name='', device='cpu'):
+    '''Returns a `torch.Generator` on `device` seeded from `seed` and the parameter `name`.'''
+    gen = torch.Generator(device=device)
+    gen.manual_seed((seed * 1_000_003 + zlib.crc32(name.encode())) % 2**63)
+    return gen
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def pack_mask(mask):
+    '''Packs a boolean `mask` into a flat uint8 tensor holding 8 mask elements per byte.'''
+    flat = mask.reshape(-1)
+    n_pad = -flat.numel() % 8
+    if n_pad: flat = torch.cat([flat, flat.new_zeros(n_pad)])
+    flat = flat.view(-1, 8)
+    packed = torch.zeros(flat.shape[0], dtype=torch.uint8, device=mask.device)
+    for i in range(8): packed |= flat[:,i].to(torch.uint8) << i
+    return packed
+
+@torch.no_grad()
+def unpack_mask(packed, sizes):
+    '''Inverse of `pack_mask`, returns a boolean mask of shape `sizes`.'''
+    n_total = int(np.prod(sizes))
+    bits = torch.tensor([1 << i for i in range(8)], dtype=torch.uint8, device=packed.device)
+    mask = packed.unsqueeze(1).bitwise_and(bits).ne(0).view(-1)[:n_total]
+    return mask.view(*sizes)
+
+# Comes from 00_core.ipynb, cell
+def _parse_structure(structure):
+    '''Returns (kind, spec) for a mask `structure`: (None, None), ('block', (bh, bw)) or ('nm', (n, m)).'''
+    if structure is None: return None, None
+    if isinstance(structure, str) and re.fullmatch(r'\d+:\d+', structure):
+        n, m = map(int, structure.split(':'))
+        if 0 < n <= m: return 'nm', (n, m)
+    elif isinstance(structure, (tuple, list)) and len(structure) == 2 and all(isinstance(o, int) and o > 0 for o in structure):
+        return 'block', tuple(structure)
+    raise ValueError(f"Unknown mask structure: {structure}. Expected None, a block size (bh, bw) or 'N:M'")
+
+def _n_of_m(sparsity, m): return min(m, max(1, round((1 - sparsity) * m)))
+
+def _matrix_shape(sizes): return sizes[0], int(np.prod(sizes[1:]))
+
+def _padded_matrix(t, rows, cols, value):
+    mat = t.reshape(*_matrix_shape(t.shape))
+    if mat.shape == (rows, cols): return mat
+    padded = mat.new_full((rows, cols), value)
+    padded[:mat.shape[0], :mat.shape[1]] = mat
+    return padded
+
+def to_blocks(t, block, value=0):
+    '''Returns the matrix view of `t`, padded with `value`, as a (n_block_rows, n_block_cols, bh*bw) tensor of blocks.'''
+    (bh, bw), (rows, cols) = block, _matrix_shape(t.shape)
+    n_rows, n_cols = -(-rows // bh), -(-cols // bw)
+    mat = _padded_matrix(t, n_rows * bh, n_cols * bw, value)
+    return mat.reshape(n_rows, bh, n_cols, bw).transpose(1, 2).reshape(n_rows, n_cols, bh * bw)
+
+def from_blocks(block_mask, block, sizes):
+    '''Expands a (n_block_rows, n_block_cols) `block_mask` to a mask of shape `sizes`.'''
+    (bh, bw), (rows, cols) = block, _matrix_shape(sizes)
+    mat = block_mask.repeat_interleave(bh, 0).repeat_interleave(bw, 1)
+    return mat[:rows, :cols].reshape(*sizes)
+
+def to_groups(t, m, value=0):
+    '''Returns the matrix view of `t`, padded with `value`, as a (rows, n_groups, m) tensor of groups of `m` consecutive weights.'''
+    rows, cols = _matrix_shape(t.shape)
+    n_groups = -(-cols // m)
+    return _padded_matrix(t, rows, n_groups * m, value).reshape(rows, n_groups, m)
+
+def from_groups(groups, sizes):
+    '''Inverse of `to_groups`, crops the padding.'''
+    rows, cols = _matrix_shape(sizes)
+    return groups.reshape(rows, -1)[:, :cols].reshape(*sizes)
+
+def _rank_in_group(scores):
+    '''Returns the rank (0 = largest) of each score within its group (last dimension), ties broken by index.'''
+    order = scores.argsort(dim=-1, descending=True, stable=True)
+    ranks = torch.arange(scores.shape[-1], device=scores.device).expand_as(order)
+    return torch.empty_like(order).scatter_(-1, order, ranks)
+
+@torch.no_grad()
+def structured_sparse_mask(sizes, sparsity, structure=None, device=None, generator=None):
+    '''
+    Returns a random boolean mask of shape `sizes` with mask `structure` and (approximately) `sparsity`,
+    created on `device` with `generator` (see `sparse_mask`).
+    '''
+    kind, spec = _parse_structure(structure)
+    if kind is None: return sparse_mask(sizes, sparsity, device, generator)
+    rows, cols = _matrix_shape(sizes)
+    if kind == 'block':
+        (bh, bw) = spec
+        return from_blocks(sparse_mask((-(-rows // bh), -(-cols // bw)), sparsity, device, generator), spec, sizes)
+    m = spec[1]
+    scores = torch.rand(rows, -(-cols // m), m, device=_mask_device(device, generator), generator=generator)
+    return from_groups(_rank_in_group(scores) < _n_of_m(sparsity, m), sizes)
+
+# Comes from 00_core.ipynb, cell
+def maybe_float(num):
+    try: return float(num)
+    except: return num
+
+def sparse_params(module):
+    '''Returns list of all (param, mask, sparsity) tuples in a module.'''
+    buffer_d = {name:b for name, b in module.named_buffers()}
+    param_mask_sparsities = [(p, buffer_d[f'{name}_mask'], maybe_float(buffer_d.get(f'{name}_sparsity')))
+                             for name, p in module.named_parameters()
+                             if f'{name}_mask' in buffer_d]
+    return list(set(param_mask_sparsities))
+
+# Comes from 00_core.ipynb, cell
+def cached_sparse_params(module):
+    '''
+    Returns list of (param, mask, sparsity buffer) references in a module, collected on the first call. They are
+    collected again when the module's buffers were replaced, e.g. by `module.to(device)` or `module.double()`.
+    '''
+    cache = module.__dict__.get('_sparse_params_cache')
+    if cache is not None and all(o._parameters.get(k) is p and o._buffers.get(f'{k}_mask') is mask
+                                 and o._buffers.get(f'{k}_sparsity') is s for (o, k), (p, mask, s) in zip(*cache)):
+        return cache[1]
+    owners, refs = [], []
+    for name, p in module.named_parameters():
+        prefix, _, k = name.rpartition('.')
+        o = module.get_submodule(prefix)
+        if f'{k}_mask' not in o._buffers: continue
+        owners.append((o, k))
+        refs.append((p, o._buffers[f'{k}_mask'], o._buffers.get(f'{k}_sparsity')))
+    module.__dict__['_sparse_params_cache'] = owners, refs
+    return refs
+
+def clear_sparse_params_cache(model):
+    '''Clears the references cached by `cached_sparse_params` (and the mask densities and patterns cached by `mask_density` and `SparseWeightGrad`) for `model` and all its submodules.'''
+    for m in model.modules():
+        m.__dict__.pop('_sparse_params_cache', None)
+        m.__dict__.pop('_mask_density_cache', None)
+        m.__dict__.pop('_mask_csr_cache', None)
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def apply_masks(module, *args, inplace=True):
+    for param, mask, sparsity in cached_sparse_params(module):
+        if inplace: param.data.mul_(mask)
+        else:       param.data = param.data.mul(mask)
+
+@torch.no_grad()
+def apply_masks_fused(params, masks, *args):
+    '''Applies all `masks` to `params` in place with a single fused multi-tensor op.'''
+    torch._foreach_mul_(params, masks)
+
+def _apply_masks_of(modules, *args):
+    '''Applies the masks of all `modules` with `apply_masks_fused`, looking them up with `cached_sparse_params`.'''
+    refs = [ref for m in modules for ref in cached_sparse_params(m)]
+    if refs: apply_masks_fused(*list(zip(*refs))[:2])
+
+# Comes from 00_core.ipynb, cell
+_sparseable_module_types = (nn.Linear,
+                            nn.Conv1d, nn.Conv2d, nn.Conv3d,
+                            nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d,
+                            nn.MultiheadAttention,
+                            nn.RNN, nn.RNNCell, nn.GRU, nn.GRUCell, nn.LSTM, nn.LSTMCell)
+
+def is_sparseable_module(m, additional_types=[]):
+    types = set(_sparseable_module_types) | set(additional_types)
+    return isinstance(m, tuple(types))
+
+# Comes from 00_core.ipynb, cell
+
+def _flatten_model(m):
+    '''Returns the leaf modules of `m`, like fastai's `flatten_model`.'''
+    children = list(m.children())
+    return [leaf for c in children for leaf in _flatten_model(c)] if children else [m]
+
+# TODO: _flatten_model gets rid of nn.MultiheadAttention which has it's own parameter 'in_proj_weight'
+#       which means sparsity_model doesn't sparsify this parameter
+def sparseable_modules(model, additional_types=[]):
+    return [m for m in _flatten_model(model) if is_sparseable_module(m, additional_types)]
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def init_kaiming_normal_sparse_(t, a=0, mode='fan_in', sparse_mode='fan_in_out', nonlinearity='leaky_relu'):
+    '''A modified kaiming normal initialization which adjusts for sparsity in weights.'''
+    # calculate sparse adjustment to standard deviation
+    #  dense kaiming init = mode / sqrt(dense_fan), e.g. for relu = 2 / sqrt(dense_fan)
+    #  sparse kaiming init = mode / sqrt(sparse_fan), note: sparse fan is unique to each input/output
+    #                      = (dense kaiming init) * sqrt(dense_fan / sparse_fan)
+    mask = mask_from_tensor(t)
+    mode = mode if mask.sum() == t.numel() else sparse_mode
+    mode_ix = ['fan_in', 'fan_out', 'fan_in_out'].index(mode)
+    dim = [1,0,1][mode_ix]
+
+    dense_fan = t.shape[dim] * t[0][0].numel()
+
+    sparse_fan_in = mask.sum(1, keepdim=True)
+    sparse_fan_out = mask.sum(0, keepdim=True)
+    # variance of 'fan_in_out' is harmonic mean of 'fan_in' and 'fan_out'
+    sparse_fan_in_out = (sparse_fan_in + sparse_fan_out) / 2
+
+    sparse_fan = [sparse_fan_in, sparse_fan_out, sparse_fan_in_out][mode_ix]
+    sparse_fan[sparse_fan==0] = 1 # avoid div by 0, can set to anything since these are masked
+
+    std_adj = torch.sqrt(dense_fan / sparse_fan)
+
+    # initialize as dense, then apply mask and apply sparse adjustment
+    mode = 'fan_in' if mode == 'fan_in_out' else mode
+    nn.init.kaiming_normal_(t, a=a, mode=mode, nonlinearity=nonlinearity)
+    return t.mul_(mask).mul_(std_adj)
+
+# Comes from 00_core.ipynb, cell
+def uniform_sparsity(params, model_sparsity):
+    return [model_sparsity] * len(params)
+
+# Comes from 00_core.ipynb, cell
+def first_layer_dense_uniform(params, model_sparsity):
+    sparsities = [0.] + [model_sparsity] * (len(params) - 1)
+    return sparsities
+
+# Comes from 00_core.ipynb, cell
+def _clamped_densities(raw_density, cost, budget):
+    '''
+    Returns densities `min(1, eps * raw_density)` for a scaling factor `eps` such that `sum(densities * cost) = budget`.
+
+    Layers with the largest `raw_density` are made dense until `eps * raw_density <= 1` for the remaining layers.
+    Rather than iterating, `eps` is computed for every possible number of dense layers at once.
+    '''
+    raw_density, cost = np.asarray(raw_density, dtype=np.float64), np.asarray(cost, dtype=np.float64)
+    order = np.argsort(-raw_density, kind='stable')
+    raw, cost = raw_density[order], cost[order]
+    # k-th element: total cost of making the first k layers dense / the remaining layers' cost per unit of `eps`
+    dense_cost = np.concatenate([[0.], np.cumsum(cost)])
+    sparse_cost = np.concatenate([np.cumsum((raw * cost)[::-1])[::-1], [0.]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        eps = (budget - dense_cost) / sparse_cost
+        # layers with equal `raw_density` are made dense together
+        is_boundary = np.concatenate([[True], raw[1:] != raw[:-1], [True]])
+        is_valid = is_boundary & (eps * np.concatenate([raw, [0.]]) <= 1)
+    is_valid[-1] = True
+    n_dense = int(np.argmax(is_valid))
+    densities = np.ones_like(raw_density)
+    densities[order[n_dense:]] = eps[n_dense] * raw[n_dense:]
+    return densities
+
+def _erdos_renyi_raw_density(p, include_kernel=True, erk_power_scale=1.0):
+    if include_kernel: return (np.sum(p.shape) / np.prod(p.shape))**erk_power_scale
+    return (np.sum(p.shape[:2]) / np.prod(p.shape[:2]))
+
+# modified from https://github.com/google-research/rigl/blob/master/rigl/sparse_utils.py.
+def erdos_renyi_sparsity(params, model_sparsity, include_kernel=True, erk_power_scale=1.0):
+    """
+    Returns a list of sparsities in the same order as params. Sparsities satisfy
+    the Erdos-Renyi(Kernel) distribution, where the model has a total parameter count
+    as one with uniform sparsities, that is, satisfying the following equation:
+    $ eps * (p_1 * N_1 + p_2 * N_2) = (1 - model_sparsity) * (N_1 + N_2) $, for some float `eps`.
+
+    Args:
+    params: list of all sparseable parameters
+    model_sparsity: target overall sparsity between 0 and 1
+    include_kernel: if True, kernel dimensions are included in the scaling (e.g. for ConvNd layers)
+    erk_power_scale: scale < 1 softens the erdos_renyi distribution (i.e. closer to uniform)
+
+    Returns a list of sparsities where values correspond to individual param sparsities.
+    """
+    # If eps * raw_density[p] > 1 for any param, it is made dense and eps is recomputed for the remaining params.
+    #
+    # E.g. where N_3, and N_4 are found to be dense:
+    # eps * (p_1 * N_1 + p_2 * N_2) + (N_3 + N_4) =
+    #    (1 - model_sparsity) * (N_1 + N_2 + N_3 + N_4)
+    n_params = np.array([p.numel() for p in params], dtype=np.float64)
+    n_ones = n_params - np.floor(model_sparsity * n_params)
+    raw_density = [_erdos_renyi_raw_density(p, include_kernel, erk_power_scale) for p in params]
+    densities = _clamped_densities(raw_density, n_params, n_ones.sum())
+    return [0. if d >= 1 else float(1. - d) for d in densities]
+
+# Comes from 00_core.ipynb, cell
+def _is_distributed(): return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+@torch.no_grad()
+def broadcast_masks(modules, src=0, group=None, grown=None):
+    '''
+    Broadcasts the masks and sparsities of `modules` from rank `src` of process `group` (default: the default group)
+    to all ranks, and applies the masks. Also broadcasts `grown`, the masks of the connections grown on rank `src` for
+    each parameter (default: none), and returns it on all ranks.
+    '''
+    refs = [ref for m in modules for ref in cached_sparse_params(m)]
+    if len(refs) == 0: return []
+    params, masks, sparsities = zip(*refs)
+    sparsities = [s for s in sparsities if s is not None]
+    # a single uint8 tensor: the bit-packed masks, followed by the bytes of the float32 sparsities
+    chunks = [pack_mask(mask) for mask in masks]
+    if sparsities: chunks.append(torch.stack([s.float() for s in sparsities]).view(torch.uint8))
+    buf = torch.cat(chunks)
+    dist.broadcast(buf, src, group=group)
+
+    offset = 0
+    for mask in masks:
+        n = -(-mask.numel() // 8)
+        mask.copy_(unpack_mask(buf[offset:offset + n], mask.shape))
+        offset += n
+    if sparsities: torch._foreach_copy_(sparsities, list(buf[offset:].clone().view(torch.float32).unbind()))
+    apply_masks_fused(list(params), list(masks))
+
+    # connections can only be grown where the new masks are set, so only these bits are sent
+    grown = grown if grown is not None else [torch.zeros_like(mask) for mask in masks]
+    buf = torch.cat([pack_mask(g[mask]) for g, mask in zip(grown, masks)])
+    dist.broadcast(buf, src, group=group)
+    res, offset = [], 0
+    for mask, n_ones in zip(masks, torch.stack([mask.sum() for mask in masks]).tolist()):
+        n = -(-n_ones // 8)
+        g = torch.zeros_like(mask)
+        g[mask] = unpack_mask(buf[offset:offset + n], (n_ones,))
+        res.append(g)
+        offset += n
+    return res
+
+# Comes from 00_core.ipynb, cell
+def _chunk(t, chunk): return t if chunk is None else t.view(-1)[slice(*chunk)]
+
+# Comes from 00_core.ipynb, cell
+def random_score(p, chunk=None, generator=None, **kwargs):
+    p = _chunk(p, chunk)
+    return torch.rand(p.shape, dtype=p.dtype, device=p.device, generator=generator)
+
+# Comes from 00_core.ipynb, cell
+def weight_magnitude(p, chunk=None, **kwargs): return _chunk(p.data, chunk).abs()
+
+# Comes from 00_core.ipynb, cell
+def gradient_magnitude(p, chunk=None, **kwargs): return _chunk(p.grad, chunk).abs()
+
+# Comes from 00_core.ipynb, cell
+# optimizer state keys of the moving averages of the gradient and the squared gradient, for fastai and PyTorch optimizers
+_grad_avg_keys, _sqr_avg_keys = ('grad_avg', 'exp_avg', 'momentum_buffer'), ('sqr_avg', 'exp_avg_sq')
+
+def _state_item(state, keys): return next((state[k] for k in keys if state.get(k) is not None), None)
+
+def _compact_state(opt, p):
+    '''Returns the `CompactOptimizerState` of `opt` if it holds the state of `p`, else None.'''
+    compact = getattr(opt, 'compact_state', None)
+    return compact if compact is not None and p in compact else None
+
+def _param_state(opt, p, chunk=None):
+    '''
+    Returns the state of `p` in `opt` (of the weights in `chunk` only, if given), expanded to the shape of `p` if it's
+    only stored for active connections.
+    '''
+    compact = _compact_state(opt, p)
+    if compact is not None: return compact.dense_state(p, chunk)
+    if chunk is None: return opt.state[p]
+    return {k: _chunk(v, chunk) if isinstance(v, Tensor) and v.shape == p.shape else v for k, v in opt.state[p].items()}
+
+def _opt_eps(opt, p, default=1e-6):
+    '''Returns the `eps` hyperparameter of the parameter group of `p` in `opt`.'''
+    compact = _compact_state(opt, p)
+    if compact is not None: p = compact.refs[id(p)][2]
+    for group in getattr(opt, 'param_groups', []):
+        if any(o is p for o in group['params']): return group.get('eps', default)
+    return default
+
+def gradient_momentum(p, opt, chunk=None, **kwargs):
+    '''Calculates the momentum of the gradient for a parameter `p` from the state of `opt`, a fastai or PyTorch optimizer.'''
+    state = _param_state(opt, p, chunk)
+    grad_avg, sqr_avg = _state_item(state, _grad_avg_keys), _state_item(state, _sqr_avg_keys)
+    if grad_avg is None:
+        raise Exception(f"Error: none of {_grad_avg_keys} found in optimizer state. Tip: set the `mom` hyperparamter in the learner, or use a PyTorch optimizer with momentum.")
+    if sqr_avg is None:
+        grad_mom = grad_avg
+    else:
+        grad_mom =  grad_avg / (torch.sqrt(sqr_avg + _opt_eps(opt, p)))
+    return grad_mom
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def momentum_redistribution(dst_cb):
+    '''
+    Modifies each sparseable parameter's target sparsity proportional to its mean absolute momentum.
+
+    Based on redistribution method in Sparse Networks From Scratch by Dettmers et al.
+    (https://arxiv.org/abs/1907.04840). Instead of evenly distributing leftover weights, as in the
+    official implementation, this method finds exact distribution amounts by making parameters dense
+    until valid sparsities are found.
+    '''
+    refs = {id(p): (p, mask, s) for m in dst_cb.modules for p, mask, s in cached_sparse_params(m)}
+    if len(refs) == 0: return
+    params, masks, sparsities = zip(*refs.values())
+
+    # stack per-parameter statistics, all on device to avoid syncing with the host
+    opt = dst_cb.opt
+    n_nonzeros = torch.stack([mask.sum() for mask in masks])
+    mean_mom = torch.stack([(gradient_momentum(p, opt) * mask).abs().sum() for p, mask in zip(params, masks)])
+    mean_mom = mean_mom / n_nonzeros
+    numel = torch.tensor([mask.numel() for mask in masks], device=n_nonzeros.device)
+    n_drop = (n_nonzeros * dst_cb.drop_grow_pct).long()
+    max_grow = (numel - n_nonzeros + n_drop).double()
+    # normalize momentum contributions to determine each parameters's growth factor
+    sparse_grow = (mean_mom / mean_mom.sum()).double() * n_drop
+    total_n_drop = n_drop.sum()
+
+    # Distribute weights proportional to parameter's momentum, without changing overall sparsity
+    #   sum_p: n_drop[p] = sum_dense_p: max_grow[p] + eps * sum_sparse_p: growth_factor[p] * n_drop[p]
+    # Goal is to find eps satisfying ^ this ^ equation where no layer's density > 1, i.e.
+    # eps * sparse_grow[p] <= max_grow[p] for all sparse p. `eps` only increases as layers are made dense,
+    # so the dense layers are those that saturate first: the smallest prefix, in order of max_grow / sparse_grow,
+    # for which the remaining layers are valid. `eps` is computed for every prefix at once.
+    order = (max_grow / sparse_grow).argsort()
+    max_grow, sparse_grow = max_grow[order], sparse_grow[order]
+    zero = max_grow.new_zeros(1)
+    dense_grow = torch.cat([zero, max_grow.cumsum(0)])
+    remaining_grow = torch.cat([sparse_grow.flip(0).cumsum(0).flip(0), zero])
+    eps = (total_n_drop - dense_grow) / remaining_grow
+    is_valid = torch.cat([eps[:-1] * sparse_grow <= max_grow, zero.bool().logical_not()])
+    n_dense = is_valid.int().argmax()
+
+    # find new sparsities, in the original parameter order
+    is_dense = torch.empty_like(is_valid[:-1]).scatter_(0, order, torch.arange(len(order), device=order.device) < n_dense)
+    n_grow = eps[n_dense] * torch.empty_like(sparse_grow).scatter_(0, order, sparse_grow)
+    new_sparsities = 1 - (n_nonzeros - n_drop + n_grow) / numel
+    new_sparsities = torch.where(is_dense, 0., new_sparsities)
+    new_sparsities = torch.where(total_n_drop == 0, torch.stack([s.double() for s in sparsities]), new_sparsities)
+
+    # set each parameter's sparsity buffer to new target sparsity
+    torch._foreach_copy_(list(sparsities), list(new_sparsities.unbind()))
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def top_k_mask(t, n_keep):
+    '''Returns a mask with `n_keep` ones cooresponding to the largest values in `t`'''
+    n_keep, flat = int(n_keep), t.flatten()
+    if n_keep <= 0: return torch.zeros_like(t, dtype=torch.bool)
+    if n_keep >= flat.numel(): return torch.ones_like(t, dtype=torch.bool)
+    # select the `n_keep`-th largest value instead of sorting all values, ties at the threshold
+    # are broken by keeping the values with the lowest index
+    threshold = flat.kthvalue(flat.numel() - n_keep + 1).values
+    mask = flat > threshold
+    n_ties = n_keep - int(mask.sum())
+    if n_ties > 0: mask[flat.eq(threshold).nonzero().squeeze(1)[:n_ties]] = True
+    return mask.view(*t.shape)
+
+# Comes from 00_core.ipynb, cell
+def _chunk_bounds(n_total, chunk_size): return [(i, min(i + chunk_size, n_total)) for i in range(0, n_total, chunk_size)]
+
+def _in_range(s, lo, hi):
+    s = s.double().reshape(-1)
+    return s[(s >= lo) & (s < hi)]
+
+@torch.no_grad()
+def _chunked_top_k_threshold(score_chunks, n_total, n_keep, max_numel, n_bins=1024):
+    '''
+    Returns (value, n_ties) such that the `n_keep` largest scores are the scores > `value` plus the first `n_ties`
+    scores equal to `value`. Each call to `score_chunks` iterates over the same scores, chunk by chunk. Scores are
+    finite, or -inf for scores that are only kept if there aren't `n_keep` other scores.
+    '''
+    if n_keep <= 0: return float('inf'), 0
+    if n_keep >= n_total: return float('-inf'), n_total
+    bounds = torch.stack([torch.stack([s.masked_fill(s.isneginf(), float('inf')).min(), s.max(), s.isneginf().sum()]).double()
+                          for s in score_chunks()])
+    n_finite = n_total - int(bounds[:,2].sum())
+    if n_keep >= n_finite: return float('-inf'), n_keep - n_finite
+    lo, hi = bounds[:,0].min().item(), bounds[:,1].max().item()
+    hi, n_above, n_range = float(np.nextafter(hi, np.inf)), 0, n_total
+    # invariant: the threshold is in [lo, hi), and `n_above` scores are >= hi
+    while n_range > max_numel and np.nextafter(lo, np.inf) < hi:
+        bins = torch.linspace(lo, hi, n_bins + 1, dtype=torch.float64)
+        bins[0], bins[-1] = lo, hi
+        counts = torch.zeros(n_bins, dtype=torch.long)
+        bin_min = torch.full((n_bins,), float('inf'), dtype=torch.float64)
+        bin_max = torch.full((n_bins,), -float('inf'), dtype=torch.float64)
+        for s in score_chunks():
+            s = _in_range(s, lo, hi)
+            idx = torch.bucketize(s, bins[1:-1].to(s.device), right=True)
+            counts += torch.bincount(idx, minlength=n_bins).cpu()
+            bin_min = bin_min.scatter_reduce(0, idx.cpu(), s.cpu(), 'amin')
+            bin_max = bin_max.scatter_reduce(0, idx.cpu(), s.cpu(), 'amax')
+        counts, j = counts.tolist(), n_bins - 1
+        while j > 0 and n_above + counts[j] < n_keep:
+            n_above += counts[j]
+            j -= 1
+        # narrow the range to the scores in the bin, so that ties (e.g. many zero scores) end the search
+        lo, hi, n_range = bin_min[j].item(), float(np.nextafter(bin_max[j].item(), np.inf)), counts[j]
+    # all remaining scores are equal to `lo`, i.e. the threshold ties with more than `max_numel` scores
+    if np.nextafter(lo, np.inf) >= hi: return lo, n_keep - n_above
+    candidates = torch.cat([_in_range(s, lo, hi) for s in score_chunks()])
+    value = candidates.kthvalue(len(candidates) - (n_keep - n_above) + 1).values
+    n_greater = n_above + int(candidates.gt(value).sum())
+    return value.item(), n_keep - n_greater
+
+@torch.no_grad()
+def _top_k_chunks(score_chunks, threshold):
+    '''Yields the top-k mask of each chunk of `score_chunks`, given `threshold` from `_chunked_top_k_threshold`.'''
+    value, n_ties = threshold
+    for s in score_chunks:
+        s = s.double().reshape(-1)
+        mask = s > value
+        if n_ties > 0:
+            ties = s.eq(value).nonzero().squeeze(1)[:n_ties]
+            mask[ties] = True
+            n_ties -= len(ties)
+        yield mask
+
+# Comes from 00_core.ipynb, cell
+class _UpdateProfiler:
+    '''Records the timings, host syncs and mask churn of each module during one update step.'''
+    def __init__(self): self.modules, self.rec, self.stack = [], None, []
+
+    @contextmanager
+    def module(self, i, m):
+        device = next(m.parameters()).device
+        self.device, self.rec = device, dict(module=i, time=0., score=0., top_k=0., reset_momentum=0.,
+                                             syncs=0, dropped=0, grown=0, regrown=0)
+        _sync(device)
+        start = time.perf_counter()
+        with _count_syncs(device) as syncs: yield
+        _sync(device)
+        self.rec['time'], self.rec['syncs'] = time.perf_counter() - start, syncs.n
+        self.modules.append({k: v if isinstance(v, (int, float)) else int(v) for k, v in self.rec.items()})
+
+    @contextmanager
+    def timer(self, name):
+        '''Adds the wall time of the block, excluding nested timers, to `name`.'''
+        _sync(self.device)
+        start = time.perf_counter()
+        self.stack.append(0.)
+        try: yield
+        finally:
+            _sync(self.device)
+            elapsed = time.perf_counter() - start
+            self.rec[name] += elapsed - self.stack.pop()
+            if self.stack: self.stack[-1] += elapsed
+
+    def count_churn(self, old_mask, keep_mask, grow_mask):
+        dropped = old_mask & keep_mask.logical_not()
+        self.rec['dropped'] += dropped.sum()
+        self.rec['grown'] += (grow_mask & keep_mask.logical_not()).sum()
+        self.rec['regrown'] += (dropped & grow_mask).sum()
+
+def _sync(device):
+    if device.type == 'cuda': torch.cuda.synchronize(device)
+
+@contextmanager
+def _count_syncs(device):
+    '''Counts the implicit host-device syncs in the block in `.n` (always 0 if `device` isn't a CUDA device).'''
+    res = SimpleNamespace(n=0)
+    if device.type != 'cuda':
+        yield res
+        return
+    debug_mode = torch.cuda.get_sync_debug_mode()
+    with warnings.catch_warnings(record=True) as ws:
+        warnings.simplefilter('always')
+        torch.cuda.set_sync_debug_mode('warn')
+        try: yield res
+        finally:
+            torch.cuda.set_sync_debug_mode(debug_mode)
+            res.n = sum('synchroniz' in str(w.message) for w in ws)
+
+def _takes_generator(f):
+    '''Returns True if function `f` takes a `generator` argument (or any keyword arguments).'''
+    try: params = inspect.signature(f).parameters.values()
+    except (TypeError, ValueError): return False
+    return any(p.name == 'generator' or p.kind == p.VAR_KEYWORD for p in params)
+
+def _mask_structure(m, param):
+    '''Returns the parsed structure of the mask of `param` in module `m` (set by `sparsify_model`).'''
+    p_name = next((n for n, p in m.named_parameters() if p is param), None)
+    return _parse_structure(getattr(m, f'{p_name}_mask_structure', None))
+
+# Comes from 00_core.ipynb, cell
+class _DynamicSparseTraining:
+    '''
+    Connectivity updates shared by `DynamicSparseTrainingCallback` and `DynamicSparseTrainingOptimizerWrapper`.
+    Subclasses provide `modules`, `opt`, `drop_grow_pct`, `distributed`, the score functions and the profiling settings.
+
+    With `distributed`, only rank 0 computes the new masks (so random scores, ties and nondeterministic kernels can't
+    make the replicas diverge), and broadcasts them to the other ranks with `broadcast_masks`.
+
+    With a `mask_log` (e.g. a `MaskHistoryWriter`), the changes of the masks made by each `rewire_module` are
+    recorded with `mask_log.append(param_name, old_mask, new_mask)`, and `mask_log.commit()` ends each update.
+
+    With `rewire_workers` > 1, modules are rewired concurrently in a thread pool (except when profiling), which helps
+    on CPU when updates are made of many small ops. Score functions taking a `generator` argument (e.g. `random_score`)
+    get a generator seeded for each parameter, so the masks don't depend on the number of threads. Score functions
+    without it use the global RNG, so modules are then rewired one after another, with a warning.
+
+    With `global_ranking`, the connections to keep and to grow are ranked across all parameters with unstructured masks
+    at once, see `_rank_globally`, instead of keeping a fixed fraction of each parameter's connections.
+
+    With `churn_threshold`, modules whose last update made few new connections skip the next updates, see
+    `_schedule_skips`. An update step where all modules skip is a plain training step.
+    '''
+    _grown = None # connections grown by an update, by parameter, e.g. to send them from rank 0 to the other ranks
+    mask_log, _param_names, rewire_workers = None, None, None
+    global_ranking, min_density = False, 0.01
+    _global_masks = None # (keep mask, grow mask) of each parameter, by id, selected by `_rank_globally`
+    churn_threshold, max_skipped_updates = None, 8
+    _skips = None # (updates left to skip, number of updates skipped last time) of modules, by index
+    _rewired = None # indices of the modules selected by `_plan_update` for the current update, None for all
+
+    def update_connectivity(self, profiler=None):
+        '''
+        Redistributes the sparsities, if `redistribute_f`, and rewires all modules. With an `_UpdateProfiler`, records
+        the stats of each module in `profiler.modules`. Returns the time taken by `redistribute_f`.
+        '''
+        old_masks, redistribute_time, self._profiler = self._old_masks(), 0., profiler
+        start = time.perf_counter()
+        try:
+            if self._receives_masks(): self._sync_masks()
+            else:
+                if self.distributed: self._grown = {}
+                if self.redistribute_f:
+                    self.redistribute_f(self)
+                redistribute_time = time.perf_counter() - start
+                self._rewire_modules()
+                if self.mask_log: self.mask_log.commit()
+                if self.distributed: self._sync_masks()
+        finally: self._profiler = None
+        self._schedule_skips(old_masks)
+        return redistribute_time
+
+    def _receives_masks(self): return self.distributed and dist.get_rank() != 0
+
+    def _sync_masks(self):
+        '''Broadcasts the masks of rank 0, and initializes the momentum of the connections grown to zero on other ranks.'''
+        refs = [ref for m in self.modules for ref in cached_sparse_params(m)]
+        grown, self._grown = self._grown, None
+        if grown is not None: grown = [grown.get(p, torch.zeros_like(mask)) for p, mask, _ in refs]
+        if not self._receives_masks(): return broadcast_masks(self.modules, grown=grown)
+        old_masks = [mask.clone() if _compact_state(self.opt, p) else None for p, mask, _ in refs]
+        for (p, _, _), old_mask, g in zip(refs, old_masks, broadcast_masks(self.modules)):
+            if old_mask is None: self.reset_momentum(p, g)
+            else: _compact_state(self.opt, p).remap(p, old_mask, g)
+
+    def profiled_connectivity_update(self, **info):
+        '''
+        Runs `update_connectivity`, recording its stats (including `info`) in `self.stats`. With `distributed`, the
+        stats of the modules are only recorded on rank 0.
+        '''
+        profiler, start = _UpdateProfiler(), time.perf_counter()
+        redistribute_time = self.update_connectivity(profiler)
+        stats = dict(**info, drop_grow_pct=self.drop_grow_pct, time=time.perf_counter() - start,
+                     redistribute_time=redistribute_time, modules=profiler.modules)
+        self.stats.append(stats)
+        if self.on_rewire: self.on_rewire(stats)
+        return stats
+
+    def _modules_to_rewire(self):
+        '''Returns the indices of the modules the next update rewires: all of them, except the ones skipping updates.'''
+        skips = self._skips if self.churn_threshold else None
+        return [i for i in range(len(self.modules)) if not skips or skips.get(i, (0, 0))[0] == 0]
+
+    def _plan_update(self):
+        '''
+        Selects the modules rewired by this update step, and counts down the updates left to skip of the other
+        modules. Returns False if no module is rewired, i.e. the step is a plain training step.
+        '''
+        self._rewired = self._modules_to_rewire()
+        if self._skips: self._skips = {i: (n if i in self._rewired else n - 1, k) for i, (n, k) in self._skips.items()}
+        return len(self._rewired) > 0
+
+    def _old_masks(self):
+        '''Returns copies of the masks of all modules before an update, to measure its churn, if `churn_threshold`.'''
+        if not self.churn_threshold: return None
+        return [[mask.clone() for _, mask, _ in cached_sparse_params(m)] for m in self.modules]
+
+    def _schedule_skips(self, old_masks):
+        '''
+        Measures the churn of the modules changed by an update, i.e. the fraction of their connections that are new.
+        Modules with a churn below `churn_threshold` have mostly regrown the connections they dropped, and skip the
+        next updates: 1 at first, then twice as many as the last time (up to `max_skipped_updates`), until an update
+        makes enough new connections again. The churn is measured from the masks only, so that all ranks agree on it.
+        '''
+        rewired, self._rewired = self._rewired, None
+        if old_masks is None: return
+        rewired = set(range(len(self.modules)) if rewired is None else rewired)
+        counts = [torch.stack([torch.stack([(mask & old.logical_not()).sum(), mask.sum(), (mask != old).sum()])
+                               for (_, mask, _), old in zip(cached_sparse_params(m), olds)]).sum(0).cpu()
+                  if olds else torch.zeros(3, dtype=torch.long) for m, olds in zip(self.modules, old_masks)]
+        skips = dict(self._skips or {})
+        for i, (n_new, n, n_changed) in enumerate(torch.stack(counts).tolist()):
+            if i not in rewired and n_changed == 0: continue
+            if n_new < self.churn_threshold * n:
+                k = min(max(1, 2 * skips.get(i, (0, 0))[1]), self.max_skipped_updates)
+                skips[i] = (k, k)
+            else: skips.pop(i, None)
+        self._skips = skips
+
+    def _timer(self, name): return self._profiler.timer(name) if self._profiler else nullcontext()
+
+    def _timed(self, it, name):
+        '''Times each step of iterator `it` with `self._timer(name)`.'''
+        if not self._profiler: return it
+        def _timed_it(it):
+            while True:
+                with self._timer(name):
+                    try: o = next(it)
+                    except StopIteration: return
+                yield o
+        return _timed_it(iter(it))
+
+    def _rewire_modules(self):
+        '''
+        Rewires all modules, in a pool of `rewire_workers` threads unless profiling, or unless a score function takes no
+        `generator` (it's seeded through the global RNG, which the threads would share).
+        '''
+        idxs = self._rewired_modules()
+        modules = [self.modules[i] for i in idxs]
+        self._global_masks = self._rank_globally(int(torch.randint(2**62, ())), modules) if self.global_ranking else None
+        seeds = torch.randint(2**62, (len(self.modules),)).tolist()
+        score_fs = [f for f in [self.keep_score_f, self.grow_score_f] if f]
+        concurrent = (self.rewire_workers or 1) > 1 and len(modules) > 1
+        if concurrent and not all(map(_takes_generator, score_fs)):
+            concurrent = False
+            warnings.warn(f'`rewire_workers={self.rewire_workers}` is ignored: score functions without a `generator` '
+                          'argument use the global RNG, so modules are rewired one after another.')
+        if self._profiler or not concurrent:
+            for i, m in zip(idxs, modules):
+                with self._profiler.module(i, m) if self._profiler else nullcontext(): self.rewire_module(m, seeds[i])
+            return
+        # record the connections grown for all modules, since switching the recording on and off isn't thread safe
+        recording = self._grown is not None
+        if not recording: self._grown = {}
+        try:
+            with ThreadPoolExecutor(self.rewire_workers) as ex:
+                futures = [ex.submit(self._rewire_module, m, seeds[i]) for i, m in zip(idxs, modules)]
+                changes = [o.result() for o in futures]
+        finally:
+            if not recording: self._grown = None
+        for o in changes: self._log_changes(o)
+
+    def _rewired_modules(self):
+        '''
+        Returns the indices of the modules to rewire: the ones selected by `_plan_update`, and the skipped ones whose
+        target sparsity was changed by `redistribute_f`, so that all modules keep their target sparsity.
+        '''
+        if self._rewired is None: return list(range(len(self.modules)))
+        if not self.redistribute_f: return self._rewired
+        return [i for i, m in enumerate(self.modules) if i in self._rewired or any(
+                s is not None and round(mask.numel() * (1 - float(s))) != int(mask.sum())
+                for _, mask, s in cached_sparse_params(m))]
+
+    @torch.no_grad()
+    def _rank_globally(self, seed, modules=None):
+        '''
+        Returns the (keep mask, grow mask) of each sparse parameter with an unstructured mask, by id, ranking the
+        scores of all parameters together: the model keeps its highest scoring connections and grows back to its
+        target number of connections, wherever the scores are highest. The thresholds are found with histograms of the scores
+        (`_chunked_top_k_threshold`), without sorting them. Each parameter keeps at least a fraction `min_density` of
+        its weights (or all of its connections, if it has fewer), so that no layer collapses. The sparsity buffers are
+        set to the new sparsities of the parameters. Only the parameters of `modules` (default: all) are ranked.
+        '''
+        modules = self.modules if modules is None else modules
+        refs = [(p, mask, s) for m in modules for p, mask, s in cached_sparse_params(m)
+                if s is not None and float(s) > 0 and _mask_structure(m, p)[0] is None]
+        if not refs: return {}
+        gens = [mask_generator(seed, str(i), p.device) for i, (p, _, _) in enumerate(refs)]
+        n_total, max_numel = sum(mask.numel() for _, mask, _ in refs), self.rewire_chunk_size or 2**16
+        n_nonzeros = [int(mask.sum()) for _, mask, _ in refs]
+        n_target = sum(round(mask.numel() * (1 - float(s))) for _, mask, s in refs)
+        n_min = [min(n, math.ceil(self.min_density * mask.numel())) for (_, mask, _), n in zip(refs, n_nonzeros)]
+        n_keep = max(0, sum(n_nonzeros) - int(sum(n_nonzeros) * self.drop_grow_pct) - sum(n_min))
+
+        # keep the `n_min` best connections of each parameter, then the best ones of all parameters
+        keep_masks, keep_scores = [], []
+        for (p, mask, _), gen, n in zip(refs, gens, n_min):
+            score = self._score(self.keep_score_f, p, gen).masked_fill(mask.logical_not(), -float('inf'))
+            keep_masks.append(top_k_mask(score, n))
+            keep_scores.append(score.masked_fill(keep_masks[-1], -float('inf')))
+        threshold = _chunked_top_k_threshold(lambda: iter(keep_scores), n_total, n_keep, max_numel)
+        keep_masks = [keep | o.view_as(keep) for keep, o in zip(keep_masks, _top_k_chunks(keep_scores, threshold))]
+        del keep_scores
+
+        # grow back to the target number of connections
+        n_grow = max(0, n_target - sum(n_min) - n_keep)
+        if self.grow_score_f and n_grow > 0:
+            # exclude all keep weights so we don't choose to grow them (grow scores can be negative)
+            grow_scores = [self._score(self.grow_score_f, p, gen).masked_fill(keep, -float('inf'))
+                           for (p, _, _), gen, keep in zip(refs, gens, keep_masks)]
+            threshold = _chunked_top_k_threshold(lambda: iter(grow_scores), n_total, n_grow, max_numel)
+            grow_masks = [o.view_as(keep) for keep, o in zip(keep_masks, _top_k_chunks(grow_scores, threshold))]
+        else: grow_masks = [torch.zeros_like(keep) for keep in keep_masks]
+
+        for (_, mask, s), keep, grow in zip(refs, keep_masks, grow_masks):
+            s.copy_(1 - (keep | grow).sum() / mask.numel())
+        return {id(p): (keep, grow) for (p, _, _), keep, grow in zip(refs, keep_masks, grow_masks)}
+
+    @torch.no_grad()
+    def rewire_module(self, m, seed=None):
+        '''Update step for one module, with random scores seeded from `seed` (default: drawn from the global RNG).'''
+        self._log_changes(self._rewire_module(m, seed))
+
+    @torch.no_grad()
+    def _rewire_module(self, m, seed=None):
+        '''Rewires module `m`, returns the (param, old mask, new mask) of its parameters if `mask_log`.'''
+        seed = int(torch.randint(2**62, ())) if seed is None else seed
+        order = {id(p): i for i, p in enumerate(m.parameters())}
+        refs = sorted(sparse_params(m), key=lambda o: order[id(o[0])])
+        old_masks = [mask.clone() for _, mask, _ in refs] if self.mask_log else None
+        for k, (param, mask, target_sparsity) in enumerate(refs):
+            gen = mask_generator(seed, str(k), param.device)
+            compact = _compact_state(self.opt, param)
+            if compact is None:
+                self.rewire_param(m, param, mask, target_sparsity, gen)
+                continue
+            # compact optimizer state is moved to the new mask, using the connections grown recorded by `reset_momentum`
+            old_mask, recording = mask.clone(), self._grown is not None
+            if not recording: self._grown = {}
+            self.rewire_param(m, param, mask, target_sparsity, gen)
+            compact.remap(param, old_mask, self._grown.get(param))
+            if not recording: self._grown = None
+        return [(param, old_mask, mask) for (param, mask, _), old_mask in zip(refs, old_masks)] if self.mask_log else []
+
+    def _log_changes(self, changes):
+        for param, old_mask, mask in changes: self.mask_log.append(self._param_name(param), old_mask, mask)
+
+    def _score(self, score_f, param, generator=None, **kwargs):
+        '''Returns `score_f(param, opt=self.opt, **kwargs)`, passing `generator` if `score_f` takes it.'''
+        if generator is not None and _takes_generator(score_f): kwargs['generator'] = generator
+        return score_f(param, opt=self.opt, **kwargs)
+
+    def _param_name(self, p):
+        '''Returns the name of parameter `p` in `self.model`.'''
+        if self._param_names is None: self._param_names = {id(q): name for name, q in self.model.named_parameters()}
+        return self._param_names[id(p)]
+
+    @torch.no_grad()
+    def rewire_param(self, m, param, mask, target_sparsity, generator=None):
+        '''Update step for one parameter of module `m`, see `rewire_module`.'''
+        if self._global_masks and id(param) in self._global_masks:
+            self._update_mask(param, mask, *self._global_masks.pop(id(param)))
+            return
+        structure = _mask_structure(m, param)
+        if structure[0] is not None:
+            self.rewire_param_structured(param, mask, target_sparsity, structure, generator)
+            return
+
+        current_sparsity = 1 - float(mask.sum() / mask.numel())
+        n_grow = int(mask.sum() * self.drop_grow_pct)
+        n_keep = mask.sum() - n_grow
+
+        # modify n_grow if actual sparsity differs from target sparsity
+        current_nonzeros = int(mask.sum())
+        target_nonzeros = round(mask.numel() * (1 - target_sparsity))
+
+        n_grow = max(0, n_grow + target_nonzeros - current_nonzeros)
+
+        if self.rewire_chunk_size and mask.numel() > self.rewire_chunk_size:
+            self.rewire_param_chunked(param, mask, int(n_keep), n_grow,
+                                      drop=current_sparsity > 0 and target_sparsity > 0, generator=generator)
+            return
+
+        # determine which weights to keep
+        if current_sparsity > 0 and target_sparsity > 0:
+            with self._timer('score'): keep_score = self._score(self.keep_score_f, param, generator)
+            with self._timer('top_k'): keep_mask = top_k_mask(keep_score, n_keep)
+        else:
+            keep_mask = torch.ones_like(mask)
+
+        # determine which weights to grow, if any
+        if self.grow_score_f:
+            with self._timer('score'):
+                grow_score = self._score(self.grow_score_f, param, generator)
+                # exclude all keep weights so we don't choose to grow them (grow scores can be negative)
+                grow_score = grow_score.masked_fill(keep_mask, -float('inf'))
+            with self._timer('top_k'): grow_mask = top_k_mask(grow_score, n_grow)
+        else:
+            grow_mask = torch.zeros_like(mask)
+        self._update_mask(param, mask, keep_mask, grow_mask)
+
+    def _update_mask(self, param, mask, keep_mask, grow_mask):
+        # update network connectivity, dropped connections are zeroed right away since masks may only
+        # be enforced after an optimizer step, which is skipped for this batch. The mask is updated in place
+        # so that its version counter signals the change (e.g. to `mask_density`)
+        if self._profiler: self._profiler.count_churn(mask, keep_mask, grow_mask)
+        mask.copy_(keep_mask | grow_mask)
+        param.data.mul_(mask)
+
+        # zero momentum for new connections
+        with self._timer('reset_momentum'): self.reset_momentum(param, grow_mask & keep_mask.logical_not())
+
+    @torch.no_grad()
+    def rewire_param_chunked(self, param, mask, n_keep, n_grow, drop=True, generator=None):
+        '''Update step for one parameter, processing `rewire_chunk_size` weights at a time.'''
+        chunks = _chunk_bounds(mask.numel(), self.rewire_chunk_size)
+        seed = generator.initial_seed() % 2**62 if generator is not None else int(torch.randint(2**31, ()))
+        def scores(score_f, offset):
+            # reseed for every chunk so that each pass sees the same scores, even for random scores
+            for j, chunk in enumerate(chunks):
+                gen = torch.Generator(param.device)
+                gen.manual_seed(seed + 2*j + offset)
+                if not _takes_generator(score_f): torch.manual_seed(seed + 2*j + offset)
+                with self._timer('score'): score = self._score(score_f, param, gen, chunk=chunk)
+                yield score if score.numel() == chunk[1] - chunk[0] else _chunk(score, chunk)
+        def keep_chunks():
+            if not drop: return (torch.ones(end - start, dtype=torch.bool, device=mask.device) for start, end in chunks)
+            return self._timed(_top_k_chunks(scores(self.keep_score_f, 0), keep_threshold), 'top_k')
+        def grow_scores():
+            # exclude all keep weights so we don't choose to grow them (grow scores can be negative)
+            for keep, score in zip(keep_chunks(), scores(self.grow_score_f, 1)):
+                yield score.reshape(-1).masked_fill(keep, -float('inf'))
+        def grow_chunks():
+            if not self.grow_score_f: return (torch.zeros(end - start, dtype=torch.bool, device=mask.device) for start, end in chunks)
+            return self._timed(_top_k_chunks(grow_scores(), grow_threshold), 'top_k')
+
+        # score functions without a `generator` argument are seeded with the global RNG, which is restored afterwards
+        devices = [param.device.index] if param.device.type == 'cuda' else []
+        score_fs = [f for f in [self.keep_score_f, self.grow_score_f] if f]
+        with nullcontext() if all(map(_takes_generator, score_fs)) else torch.random.fork_rng(devices=devices):
+            n_total, max_numel = mask.numel(), self.rewire_chunk_size
+            with self._timer('top_k'):
+                if drop: keep_threshold = _chunked_top_k_threshold(lambda: scores(self.keep_score_f, 0), n_total, n_keep, max_numel)
+                if self.grow_score_f: grow_threshold = _chunked_top_k_threshold(grow_scores, n_total, n_grow, max_numel)
+            # the mask is only updated once all chunks are scored, since scores can depend on it (e.g. compact state)
+            flat_mask, flat_param, new_mask = mask.view(-1), param.data.view(-1), torch.empty_like(mask.view(-1))
+            for (start, end), keep, grow in zip(chunks, keep_chunks(), grow_chunks()):
+                if self._profiler: self._profiler.count_churn(flat_mask[start:end], keep, grow)
+                new_mask[start:end] = keep | grow
+                flat_param[start:end].mul_(new_mask[start:end])
+                with self._timer('reset_momentum'): self.reset_momentum(param, grow & keep.logical_not(), chunk=(start, end))
+            mask.copy_(new_mask.view_as(mask))
+
+    @torch.no_grad()
+    def rewire_param_structured(self, param, mask, target_sparsity, structure, generator=None):
+        '''Update step for one parameter with a structured mask, keeping its structure.'''
+        kind, spec = structure
+        with self._timer('score'):
+            keep_score = self._score(self.keep_score_f, param, generator)
+            grow_score = self._score(self.grow_score_f, param, generator) if self.grow_score_f else None
+        if kind == 'block':
+            # score, keep and grow whole blocks
+            block_mask = to_blocks(mask, spec, value=False).any(-1)
+            n_nonzeros, n_total = int(block_mask.sum()), block_mask.numel()
+            n_grow = int(n_nonzeros * self.drop_grow_pct)
+            n_keep = n_nonzeros - n_grow
+            n_grow = max(0, n_grow + round(n_total * (1 - target_sparsity)) - n_nonzeros)
+            with self._timer('top_k'):
+                if n_nonzeros < n_total and target_sparsity > 0:
+                    keep_blocks = top_k_mask(to_blocks(keep_score, spec).sum(-1), n_keep)
+                else:
+                    keep_blocks = torch.ones_like(block_mask)
+                if grow_score is not None:
+                    grow_blocks = to_blocks(grow_score, spec).sum(-1)
+                    grow_blocks = top_k_mask(grow_blocks.masked_fill(keep_blocks, -float('inf')), n_grow)
+                else:
+                    grow_blocks = torch.zeros_like(block_mask)
+            keep_mask, grow_mask = from_blocks(keep_blocks, spec, mask.shape), from_blocks(grow_blocks, spec, mask.shape)
+        else:
+            # drop the lowest scoring weights of all groups, then regrow each group to `n` weights
+            n, m = _n_of_m(target_sparsity, spec[1]), spec[1]
+            groups_mask, is_weight = to_groups(mask, m, value=False), to_groups(torch.ones_like(mask), m, value=False)
+            n_nonzeros = int(groups_mask.sum())
+            with self._timer('top_k'):
+                keep_groups = to_groups(keep_score, m).masked_fill(groups_mask.logical_not(), -float('inf'))
+                keep_mask = top_k_mask(keep_groups, n_nonzeros - int(n_nonzeros * self.drop_grow_pct))
+                keep_mask &= _rank_in_group(keep_groups) < n
+                if grow_score is not None:
+                    grow_groups = to_groups(grow_score, m).masked_fill(keep_mask | is_weight.logical_not(), -float('inf'))
+                    grow_mask = _rank_in_group(grow_groups) < n - keep_mask.sum(-1, keepdim=True)
+                    grow_mask &= is_weight & keep_mask.logical_not()
+                else:
+                    grow_mask = torch.zeros_like(keep_mask)
+            keep_mask, grow_mask = from_groups(keep_mask, mask.shape), from_groups(grow_mask, mask.shape)
+        self._update_mask(param, mask, keep_mask, grow_mask)
+
+    @torch.no_grad()
+    def reset_momentum(self, p, mask, chunk=None):
+        '''Initializes the momentum of the connections in `mask` to zero.'''
+        if self._grown is not None:
+            grown = _chunk(self._grown.setdefault(p, torch.zeros(p.shape, dtype=torch.bool, device=p.device)), chunk)
+            grown.copy_(mask.view_as(grown))
+        if _compact_state(self.opt, p) is not None: return # initialized by `CompactOptimizerState.remap`
+        state = self.opt.state[p]
+        for k in _grad_avg_keys + _sqr_avg_keys:
+            if state.get(k) is not None: _chunk(state[k], chunk).mul_(mask.logical_not())
+
+# Comes from 00_core.ipynb, cell
+SET_presets = {'keep_score_f': weight_magnitude, 'grow_score_f': random_score,
+               'initial_drop_grow_pct': 0.3, 'stop_pct': 1.0,}
+
+# Comes from 00_core.ipynb, cell
+SNFS_presets = {'redistribute_f':momentum_redistribution,
+                'keep_score_f': weight_magnitude, 'grow_score_f': gradient_momentum,
+                'initial_drop_grow_pct': 0.5, 'stop_pct': 1.0,}
+
+# Comes from 00_core.ipynb, cell
+RigL_presets = {'keep_score_f': weight_magnitude, 'grow_score_f': gradient_magnitude,
+                'initial_drop_grow_pct':0.3, 'stop_pct':0.75, 'batches_per_update': 100}
+
+# Comes from 00_core.ipynb, cell
+class DynamicSparseTrainingOptimizerWrapper(_DynamicSparseTraining):
+    '''Wraps optimizer `opt` of `model` to dynamically update the network connectivity in `step()`.'''
+    def __init__(self, model, opt, n_steps, sparse_modules=None,
+                 batches_per_update=100, initial_drop_grow_pct=0.3, stop_pct=0.75,
+                 keep_score_f=weight_magnitude, grow_score_f=gradient_magnitude, redistribute_f=None,
+                 rewire_chunk_size=None, step_on_update=True, profile=False, on_rewire=None, distributed=None,
+                 mask_log=None, rewire_workers=None, sparse_grad=False, global_ranking=False, min_density=0.01,
+                 churn_threshold=None, max_skipped_updates=8):
+        self.model, self.opt, self.n_steps = model, opt, n_steps
+        self.modules = sparse_modules if sparse_modules is not None else sparseable_modules(model)
+        self.batches_per_update, self.initial_drop_grow_pct, self.stop_pct = batches_per_update, initial_drop_grow_pct, stop_pct
+        self.keep_score_f, self.grow_score_f, self.redistribute_f = keep_score_f, grow_score_f, redistribute_f
+        self.rewire_chunk_size, self.step_on_update = rewire_chunk_size, step_on_update
+        self.profile, self.on_rewire, self.stats, self._profiler = profile, on_rewire, [], None
+        self.mask_log, self.rewire_workers = mask_log, rewire_workers
+        self.global_ranking, self.min_density = global_ranking, min_density
+        self.churn_threshold, self.max_skipped_updates = churn_threshold, max_skipped_updates
+        self.distributed = _is_distributed() if distributed is None else distributed
+        self.n_step, self.is_update_step = 0, False
+        self.drop_grow_pct = self.drop_grow_pct_sched(0.)
+        self._sparse_grad = SparseWeightGrad(self.modules) if sparse_grad else None
+        self._update_sparse_grad()
+
+    def drop_grow_pct_sched(self, pct_train):
+        '''Cosine annealing of `initial_drop_grow_pct` to 0 at `stop_pct` of training, as in the callback.'''
+        if pct_train >= self.stop_pct: return 0.
+        return self.initial_drop_grow_pct * (1 + math.cos(math.pi * pct_train / self.stop_pct)) / 2
+
+    def _is_update_step(self):
+        '''Returns True if the next call of `step` updates the connectivity.'''
+        return (self.n_step > 0
+                and self.n_step % self.batches_per_update == 0
+                and self.drop_grow_pct_sched(self.n_step / self.n_steps) > 0
+                and self.n_step + 1 < self.n_steps)
+
+    def _update_sparse_grad(self):
+        # only the batches of update steps get dense weight gradients, to score the connections to grow
+        if self._sparse_grad is not None:
+            self._sparse_grad.enabled = not (self._is_update_step() and self._modules_to_rewire())
+
+    def step(self, closure=None):
+        '''Takes an optimizer step, and updates the connectivity every `batches_per_update` steps.'''
+        self.drop_grow_pct = self.drop_grow_pct_sched(self.n_step / self.n_steps)
+        self.is_update_step = self._is_update_step() and self._plan_update()
+        self.n_step += 1
+        try: return self._update_step(closure) if self.is_update_step else self.opt.step(closure)
+        finally: self._update_sparse_grad()
+
+    def _update_step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad(): loss = closure()
+        if self.profile: self.profiled_connectivity_update(step=self.n_step - 1)
+        else: self.update_connectivity()
+        if self.step_on_update:
+            self.opt.step()
+            # the masks may only be enforced before the next forward pass, dropped connections are zeroed right away
+            _apply_masks_of(self.modules)
+        return loss
+
+    def zero_grad(self, set_to_none=True): self.opt.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self): return {**self.opt.state_dict(), 'dst_n_step': self.n_step, 'dst_skips': self._skips}
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        self.n_step = state_dict.pop('dst_n_step', self.n_step)
+        self._skips = state_dict.pop('dst_skips', self._skips)
+        self.opt.load_state_dict(state_dict)
+        self._update_sparse_grad()
+
+    def __getattr__(self, name):
+        # everything else, e.g. `param_groups` and `state`, comes from the wrapped optimizer
+        if name == 'opt' or name.startswith('__'): raise AttributeError(name)
+        return getattr(self.opt, name)
+
+    _docs = dict(__init__='''Args:
+    model: the sparse model, see `sparsify_model`
+    opt: the optimizer of `model`, e.g. `torch.optim.SGD`. Learning rate schedulers should be created with `opt`
+    n_steps: the total number of optimizer steps (i.e. batches) of training, to schedule the updates
+    batches_per_update: # of batches per update
+    step_on_update: if True (default), also take the optimizer step on update steps, using the batch's gradients
+        after rewiring. Otherwise, only the connectivity is updated on those steps, as in `DynamicSparseTrainingCallback`
+    See `DynamicSparseTrainingCallback` for the other arguments. In `self.stats`, updates are identified by `step`.''')
+
+# Comes from 00_core.ipynb, cell
+class CompactOptimizerState:
+    '''Stores the state of `opt` (PyTorch or fastai optimizer) only for the active connections of the masked parameters in `modules`.'''
+    def __init__(self, opt, modules):
+        self.opt, self.refs, self._chunk_pos = opt, {}, {}
+        refs = [(p, mask) for m in modules for p, mask, _ in cached_sparse_params(m)]
+        # replace each masked parameter in `opt` by a compact copy of its active weights, moving its state
+        param_lists = opt.param_lists if hasattr(opt, 'param_lists') else [g['params'] for g in opt.param_groups]
+        for p, mask in refs:
+            for params in param_lists:
+                j = next((j for j, o in enumerate(params) if o is p), None)
+                if j is None: continue
+                q = nn.Parameter(p.data[mask])
+                params[j], self.refs[id(p)] = q, (p, mask, q)
+                if p in opt.state:
+                    opt.state[q] = {k: v[mask] if isinstance(v, Tensor) and v.shape == p.shape else v
+                                    for k, v in opt.state.pop(p).items()}
+        self._step, self._zero_grad = opt.step, opt.zero_grad
+        opt.step, opt.zero_grad, opt.compact_state = self.step, self.zero_grad, self
+
+    def __contains__(self, p): return id(p) in self.refs
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        '''Gathers the active weights and gradients, runs the optimizer step on them, and scatters them back.'''
+        for p, mask, q in self.refs.values():
+            torch.masked_select(p.data, mask, out=q.data)
+            q.grad = None if p.grad is None else p.grad[mask]
+        loss = self._step() if closure is None else self._step(closure)
+        for p, mask, q in self.refs.values():
+            p.data.masked_scatter_(mask, q.data)
+            q.grad = None
+        return loss
+
+    def zero_grad(self, *args, **kwargs):
+        self._zero_grad(*args, **kwargs)
+        for p, _, _ in self.refs.values(): p.grad = None
+
+    def dense_state(self, p, chunk=None):
+        '''Returns the state of `p` (of the weights in `chunk` only, if given), with zeros for the masked connections.'''
+        p, mask, q = self.refs[id(p)]
+        active = slice(None)
+        if chunk is not None:
+            # the active connections of `chunk` follow those before it, counted incrementally when chunks come in order
+            (start, end), flat = chunk, mask.view(-1)
+            pos = self._chunk_pos.get(id(p))
+            offset = pos[2] if pos is not None and pos[:2] == (flat._version, start) else int(flat[:start].sum())
+            mask = flat[start:end]
+            active = slice(offset, offset + int(mask.sum()))
+            self._chunk_pos[id(p)] = (flat._version, end, active.stop)
+        return {k: torch.zeros(mask.shape, dtype=v.dtype, device=v.device).masked_scatter_(mask, v[active])
+                   if isinstance(v, Tensor) and v.shape == q.shape else v
+                for k, v in self.opt.state[q].items()}
+
+    @torch.no_grad()
+    def remap(self, p, old_mask, grown=None):
+        '''
+        Moves the state of `p` from the connections in `old_mask` to the connections in its current mask.
+        Connections in `grown` (default: those not in `old_mask`) start from zero state.
+
+        The compact state tensors change size with the number of active connections, so an optimizer state dict
+        only loads into a model with the masks it was saved with: save and load it together with the model.
+        '''
+        p, mask, q = self.refs[id(p)]
+        keep = old_mask & mask if grown is None else old_mask & mask & grown.logical_not()
+        state = self.opt.state[q]
+        for k, v in state.items():
+            if isinstance(v, Tensor) and v.shape == q.shape:
+                state[k] = torch.zeros(p.shape, dtype=v.dtype, device=v.device).masked_scatter_(old_mask, v).mul_(keep)[mask]
+        q.data, q.grad = p.data[mask], None
+
+    def state_numel(self):
+        '''Returns the number of elements of all state tensors of `opt`.'''
+        return sum(v.numel() for state in self.opt.state.values() for v in state.values() if isinstance(v, Tensor))
+
+# Comes from 00_core.ipynb, cell
+def _mask_csr(m, dtype):
+    '''
+    Returns the weight mask of `m` as a 2D CSR tensor of `dtype` and the flat indices of its active connections,
+    cached until the mask is modified in place or replaced.
+    '''
+    mask = m.weight_mask
+    mask_ref, version, csr, idxs = m.__dict__.get('_mask_csr_cache', (None, None, None, None))
+    if mask_ref is None or mask_ref() is not mask or version != mask._version or csr.dtype != dtype:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning) # sparse CSR support is in beta
+            csr = mask.reshape(mask.shape[0], -1).to(dtype).to_sparse_csr()
+        idxs = mask.reshape(-1).nonzero().squeeze(1)
+        m.__dict__['_mask_csr_cache'] = (weakref.ref(mask), mask._version, csr, idxs)
+    return csr, idxs
+
+def _sampled_weight_grad(grad_out, inp, mask_csr, weight):
+    '''Returns the gradient `grad_out.T @ inp` of `weight`, only computed for the connections in `mask_csr`.'''
+    csr, idxs = mask_csr
+    values = torch.sparse.sampled_addmm(csr, grad_out.t(), inp, beta=0.).values()
+    # CSR values are in row-major order, like the flat indices
+    return torch.zeros(weight.numel(), dtype=values.dtype, device=values.device).index_copy_(0, idxs, values).view_as(weight)
+
+class _SparseGradLinear(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, x, weight, bias, mask_csr):
+        ctx.save_for_backward(x, weight)
+        ctx.mask_csr = mask_csr
+        return F.linear(x, weight, bias)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        x, weight = ctx.saved_tensors
+        grad_2d = grad_out.reshape(-1, grad_out.shape[-1])
+        grad_x = grad_out @ weight if ctx.needs_input_grad[0] else None
+        grad_w = _sampled_weight_grad(grad_2d, x.reshape(-1, x.shape[-1]), ctx.mask_csr, weight) if ctx.needs_input_grad[1] else None
+        grad_b = grad_2d.sum(0) if ctx.needs_input_grad[2] else None
+        return grad_x, grad_w, grad_b, None
+
+def _supports_sparse_grad(m): return isinstance(m, nn.Linear) and 'weight_mask' in m._buffers
+
+def _sparse_grad_forward(m, sparse_grad, x):
+    if (not (sparse_grad.enabled and torch.is_grad_enabled() and m.weight.requires_grad) or torch.is_autocast_enabled()
+        or mask_density(m, 'weight') > sparse_grad.max_density): return type(m).forward(m, x)
+    return _SparseGradLinear.apply(x, m.weight, m.bias, _mask_csr(m, m.weight.dtype))
+
+class SparseWeightGrad:
+    '''
+    Makes the masked nn.Linear modules in `modules` compute the gradients of their weights only for the active
+    connections while `enabled`, if their density is at most `max_density`. Call `remove` to restore the modules.
+    '''
+    def __init__(self, modules, enabled=True, max_density=0.02):
+        self.enabled, self.max_density = enabled, max_density
+        self.modules = [m for m in modules if _supports_sparse_grad(m)]
+        for m in self.modules: m.forward = partial(_sparse_grad_forward, m, self)
+
+    def remove(self):
+        for m in self.modules: m.__dict__.pop('forward', None)
+        self.modules = []
+
+# Comes from 00_core.ipynb, cell
+def _n_rows(x):
+    '''Returns the number of vectors in `x` that a layer is applied to, i.e. the product of all but its last dimension.'''
+    if isinstance(x, nn.utils.rnn.PackedSequence): x = x.data
+    return int(np.prod(x.shape[:-1]))
+
+def _weight_flops(m, i, o):
+    '''
+    Returns a dict with the dense forward FLOPs (multiply-accumulates) for inputs `i` and output `o` of each
+    weight in `m`. FLOPs that don't involve weights (i.e. attention in nn.MultiheadAttention) have key None.
+    '''
+    if isinstance(m, nn.Linear):
+        return {'weight': _n_rows(i[0]) * m.weight.numel()}
+    if isinstance(m, (nn.Conv1d, nn.Conv2d, nn.Conv3d)):
+        # each output position is computed from all kernel weights of its group
+        return {'weight': o.numel() // m.out_channels * m.weight.numel()}
+    if isinstance(m, (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)):
+        # each input position is multiplied by all kernel weights of its group
+        return {'weight': i[0].numel() // m.in_channels * m.weight.numel()}
+    if isinstance(m, (nn.RNNBase, nn.RNNCellBase)):
+        # all weights are applied once per timestep (and layer/direction for nn.RNNBase)
+        return {n: _n_rows(i[0]) * p.numel() for n, p in m.named_parameters() if 'weight' in n}
+    if isinstance(m, nn.MultiheadAttention):
+        q, k = i[0], i[1]
+        n_q, n_k = _n_rows(q), _n_rows(k)
+        src_len = k.shape[1] if m.batch_first and k.dim() == 3 else k.shape[0]
+        flops = {'out_proj.weight': n_q * m.out_proj.weight.numel(),
+                 None: 2 * n_q * src_len * m.embed_dim} # q @ k.T and attn @ v
+        if m._qkv_same_embed_dim: flops['in_proj_weight'] = (n_q + 2 * n_k) * m.embed_dim**2
+        else: flops.update({'q_proj_weight': n_q * m.q_proj_weight.numel(),
+                            'k_proj_weight': n_k * m.k_proj_weight.numel(),
+                            'v_proj_weight': n_k * m.v_proj_weight.numel()})
+        return flops
+    return {}
+
+def _shape(x):
+    if isinstance(x, nn.utils.rnn.PackedSequence): return tuple(x.data.shape)
+    return tuple(x.shape) if isinstance(x, Tensor) else None
+
+def module_flops(m, i, o):
+    '''Returns the dense forward FLOPs of each weight in `m` (see `_weight_flops`), computed once per input shape.'''
+    cache = m.__dict__.setdefault('_flops_cache', {})
+    key = tuple(_shape(x) for x in i)
+    if key not in cache: cache[key] = _weight_flops(m, i, o)
+    return cache[key]
+
+def mask_density(m, name):
+    '''
+    Returns the fraction of ones in the mask of parameter `name` in `m`, or 1. if it has no mask. The density is
+    cached until the mask is modified in place (as in `DynamicSparseTrainingCallback.rewire_module`) or replaced.
+    '''
+    *path, p_name = name.split('.')
+    owner = m.get_submodule('.'.join(path))
+    mask = owner._buffers.get(f'{p_name}_mask')
+    if mask is None: return 1.
+    cache = owner.__dict__.setdefault('_mask_density_cache', {})
+    mask_ref, version, density = cache.get(p_name, (None, None, None))
+    if mask_ref is None or mask_ref() is not mask or version != mask._version:
+        density = float(mask.sum()) / mask.numel()
+        cache[p_name] = (weakref.ref(mask), mask._version, density)
+    return density
+
+def flop_counter_hook(m, i, o):
+    '''Counts forward FLOPs from sparseable modules'''
+    return sum(module_flops(m, i, o).values())
+
+def sparse_flop_counter_hook(m, i, o):
+    '''Counts forward FLOPs from unmasked weights.'''
+    return int(sum(flops * (1 if n is None else mask_density(m, n)) for n, flops in module_flops(m, i, o).items()))
+
+def backward_flop_counter_hook(m, i, o, sparse=False):
+    '''
+    Counts backward FLOPs from sparseable modules: the gradients of the weights, which are as sparse as the weights
+    if `sparse`, and the gradients of the inputs, if they are needed.
+    '''
+    flops = (sparse_flop_counter_hook if sparse else flop_counter_hook)(m, i, o)
+    # the first layer of a model doesn't backpropagate to its input, except through recurrent/attention states
+    needs_input_grad = (isinstance(m, (nn.RNNBase, nn.RNNCellBase, nn.MultiheadAttention)) or
+                        any(getattr(x, 'requires_grad', False) for x in i))
+    return 2 * flops if needs_input_grad else flops
+
+def flop_modules(model):
+    '''Returns the sparseable modules in `model`, whose FLOPs are counted, including nn.MultiheadAttention.'''
+    if is_sparseable_module(model): return [model]
+    return [fm for m in model.children() for fm in flop_modules(m)]
+
+def _hooked_forward(model, xb, modules, hook):
+    '''Runs `model` on `xb` and returns the result of `hook(m, input, output)` for the last call of each of `modules`.'''
+    stored = [None] * len(modules)
+    def _hook(i, m, inp, out): stored[i] = hook(m, inp, out)
+    handles = [m.register_forward_hook(partial(_hook, i)) for i, m in enumerate(modules)]
+    try: model(xb)
+    finally:
+        for h in handles: h.remove()
+    return stored
+
+def count_flops(model, xb, sparse=False, backward=False):
+    '''Counts the forward FLOPs of `model` for a batch `xb`, or the backward FLOPs of a training step if `backward`.'''
+    hook = sparse_flop_counter_hook if sparse else flop_counter_hook
+    if backward: hook = partial(backward_flop_counter_hook, sparse=sparse)
+    return sum(_hooked_forward(model, xb, flop_modules(model), hook))
+
+# Comes from 00_core.ipynb, cell
+@torch.no_grad()
+def param_flops(model, xb):
+    '''Returns a dict mapping each weight of the sparseable modules in `model` to its dense forward FLOPs for input `xb`.'''
+    modules = flop_modules(model)
+    m_flops = _hooked_forward(model, xb, modules, module_flops)
+    return {p: flops[p_name] for m, flops in zip(modules, m_flops)
+            for p_name, p in m.named_parameters() if p_name in flops}
+
+def flop_budget_sparsity(model, xb, flops_weight=1., include_kernel=True, erk_power_scale=1.0):
+    '''
+    Returns a `sparse_f` for `sparsify_model`, where `model_sparsity` is the fraction of the FLOPs of `model` on
+    sample input `xb` to remove (or of a combined FLOPs & parameters budget if `flops_weight` < 1).
+    '''
+    p2flops = param_flops(model, xb)
+    def _flop_budget_sparsity(params, model_sparsity):
+        flops = np.array([p2flops.get(p, 0) for p in params], dtype=np.float64)
+        n_params = np.array([p.numel() for p in params], dtype=np.float64)
+        cost = flops_weight * flops / max(flops.sum(), 1) + (1 - flops_weight) * n_params / n_params.sum()
+        raw_density = [_erdos_renyi_raw_density(p, include_kernel, erk_power_scale) for p in params]
+        densities = _clamped_densities(raw_density, cost, (1 - model_sparsity) * cost.sum())
+        return [0. if d >= 1 else float(1. - d) for d in densities]
+    return _flop_budget_sparsity
\ No newline at end of file
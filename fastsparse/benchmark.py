@@ -0,0 +1,291 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 03_benchmark.ipynb (unless otherwise specified).
+
+__all__ = ['synthetic_model', 'PeakMemory', 'measure', 'bench_sparsify_model', 'bench_apply_masks', 'bench_forward',
+           'bench_backward', 'bench_top_k_mask', 'bench_rewire_module', 'bench_rewire_workers',
+           'bench_momentum_redistribution', 'bench_erdos_renyi_sparsity', 'benchmarks', 'import_time', 'bench_import',
+           'run_benchmarks', 'save_benchmarks', 'load_benchmarks', 'compare_benchmarks', 'benchmark_cli', 'compare_cli']
+
+# Cell
+import os
+import time
+import json
+import platform
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+import numpy as np
+import torch
+import torch.nn as nn
+from fastcore.script import call_parse
+from fastai.optimizer import SGD
+from .core import *
+
+# Cell
+def synthetic_model(width, depth):
+    '''Returns an MLP of `depth` nn.Linear layers with `width` inputs and outputs.'''
+    layers = []
+    for _ in range(depth): layers += [nn.Linear(width, width), nn.ReLU()]
+    return nn.Sequential(*layers[:-1])
+
+def _rss():
+    '''Returns the resident memory of this process in bytes, or None if it can't be read.'''
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError): return None
+
+class PeakMemory:
+    '''
+    Context manager recording in `peak` the peak memory increase (in bytes) of `device` while it is open:
+    allocated CUDA memory, or the process' resident memory sampled every `interval` seconds on CPU.
+    '''
+    def __init__(self, device='cpu', interval=1e-3):
+        self.device, self.interval, self.peak = torch.device(device), interval, None
+    def __enter__(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            self.start = torch.cuda.memory_allocated(self.device)
+        else:
+            self.start = self.max_rss = _rss()
+            self.stop = threading.Event()
+            self.thread = threading.Thread(target=self._sample, daemon=True)
+            if self.start is not None: self.thread.start()
+        return self
+    def _sample(self):
+        while not self.stop.wait(self.interval): self.max_rss = max(self.max_rss, _rss())
+    def __exit__(self, *args):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+            self.peak = torch.cuda.max_memory_allocated(self.device) - self.start
+        elif self.start is not None:
+            self.stop.set()
+            self.thread.join()
+            self.peak = max(self.max_rss, _rss()) - self.start
+
+def _sync(device):
+    if torch.device(device).type == 'cuda': torch.cuda.synchronize(device)
+
+def measure(f, n_iter=10, setup=None, device='cpu'):
+    '''
+    Returns a dict with the median wall `time` (in seconds) of `n_iter` calls of `f` and the `peak_mem` increase
+    during all calls. If `setup` is given, `f` is called with its result, and the time of `setup` is excluded.
+    '''
+    times = []
+    with PeakMemory(device) as mem:
+        for _ in range(n_iter):
+            args = setup() if setup else ()
+            _sync(device)
+            start = time.perf_counter()
+            f(*args)
+            _sync(device)
+            times.append(time.perf_counter() - start)
+    return {'time': float(np.median(times)), 'peak_mem': mem.peak}
+
+# Cell
+def _sparse_model(width, depth, sparsity, device, **kwargs):
+    model = synthetic_model(width, depth).to(device)
+    sparsify_model(model, sparsity, sparse_f=uniform_sparsity, **kwargs)
+    return model
+
+def _dst_callback(model, xb):
+    '''Returns a `DynamicSparseTrainingCallback` ready to rewire `model`, after one training step on `xb`.'''
+    opt = SGD(list(model.parameters()), lr=0.1, mom=0.9)
+    model(xb).pow(2).mean().backward()
+    opt.step()
+    dst_cb = DynamicSparseTrainingCallback(sparse_modules=sparseable_modules(model))
+    dst_cb.learn, dst_cb.drop_grow_pct = SimpleNamespace(opt=opt, model=model), 0.3
+    return dst_cb
+
+def bench_sparsify_model(width, depth, sparsity, n_iter=10, device='cpu'):
+    setup = lambda: (synthetic_model(width, depth).to(device),)
+    return measure(lambda model: sparsify_model(model, sparsity), n_iter, setup, device)
+
+def bench_apply_masks(width, depth, sparsity, n_iter=10, device='cpu'):
+    modules = sparseable_modules(_sparse_model(width, depth, sparsity, device, enforce_mask=False))
+    def _apply_masks():
+        for m in modules: apply_masks(m)
+    return measure(_apply_masks, n_iter, device=device)
+
+def bench_forward(width, depth, sparsity, n_iter=10, device='cpu', bs=64):
+    '''Times forward passes with masks enforced by hooks (`enforce_mask` in `sparsify_model`) and without.'''
+    xb = torch.randn(bs, width, device=device)
+    dense_model = synthetic_model(width, depth).to(device)
+    with torch.no_grad():
+        dense = measure(dense_model, n_iter, setup=lambda: (xb,), device=device)
+        results = []
+        for mode in ['module', 'model']:
+            model = _sparse_model(width, depth, sparsity, device, enforce_mask=mode)
+            res = measure(model, n_iter, setup=lambda: (xb,), device=device)
+            res.update(enforce_mask=mode, dense_time=dense['time'], overhead=res['time'] - dense['time'])
+            results.append(res)
+    return results
+
+def _sparse_conv_model(channels, depth, sparsity, device):
+    '''Returns a sparse CNN of `depth` 3x3 nn.Conv2d layers with `channels` input and output channels.'''
+    layers = []
+    for _ in range(depth): layers += [nn.Conv2d(channels, channels, 3, padding=1), nn.ReLU()]
+    model = nn.Sequential(*layers[:-1]).to(device)
+    sparsify_model(model, sparsity, sparse_f=uniform_sparsity, enforce_mask=False)
+    return model
+
+def bench_backward(width, depth, sparsity, n_iter=10, device='cpu', bs=64, size=16):
+    '''
+    Times forward & backward passes with dense weight gradients and with `SparseWeightGrad`, of the synthetic MLP and
+    of a CNN with `width // 16` channels on `size`x`size` images.
+    '''
+    models = [('linear', _sparse_model(width, depth, sparsity, device, enforce_mask=False),
+               torch.randn(bs, width, device=device)),
+              ('conv2d', _sparse_conv_model(max(width // 16, 1), depth, sparsity, device),
+               torch.randn(bs, max(width // 16, 1), size, size, device=device))]
+    results = []
+    for module, model, xb in models:
+        for sparse_grad in [False, True]:
+            sg = SparseWeightGrad(sparseable_modules(model), enabled=sparse_grad)
+            def _backward():
+                model.zero_grad()
+                model(xb).pow(2).mean().backward()
+            results.append(dict(measure(_backward, n_iter, device=device), module=module, sparse_grad=sparse_grad))
+            sg.remove()
+    return results
+
+def bench_top_k_mask(width, depth, sparsity, n_iter=10, device='cpu'):
+    t = torch.randn(depth * width, width, device=device)
+    return measure(lambda: top_k_mask(t, round((1 - sparsity) * t.numel())), n_iter, device=device)
+
+def bench_rewire_module(width, depth, sparsity, n_iter=10, device='cpu', bs=64):
+    model = _sparse_model(width, depth, sparsity, device)
+    dst_cb = _dst_callback(model, torch.randn(bs, width, device=device))
+    def _rewire():
+        for m in dst_cb.modules: dst_cb.rewire_module(m)
+    return measure(_rewire, n_iter, device=device)
+
+def bench_rewire_workers(width, depth, sparsity, n_iter=10, device='cpu', bs=64, workers=(1, 4)):
+    '''Times rewiring all modules one after another and in pools of `rewire_workers` threads.'''
+    model = _sparse_model(width, depth, sparsity, device)
+    dst_cb = _dst_callback(model, torch.randn(bs, width, device=device))
+    results = []
+    for n in workers:
+        dst_cb.rewire_workers = n
+        results.append(dict(measure(dst_cb._rewire_modules, n_iter, device=device), rewire_workers=n))
+    return results
+
+def bench_momentum_redistribution(width, depth, sparsity, n_iter=10, device='cpu', bs=64):
+    model = _sparse_model(width, depth, sparsity, device)
+    dst_cb = _dst_callback(model, torch.randn(bs, width, device=device))
+    return measure(lambda: momentum_redistribution(dst_cb), n_iter, device=device)
+
+def bench_erdos_renyi_sparsity(width, depth, sparsity, n_iter=10, device='cpu'):
+    params = [m.weight for m in sparseable_modules(synthetic_model(width, depth))]
+    return measure(lambda: erdos_renyi_sparsity(params, sparsity), n_iter, device=device)
+
+benchmarks = {'sparsify_model': bench_sparsify_model, 'apply_masks': bench_apply_masks, 'forward': bench_forward,
+              'backward': bench_backward,
+              'top_k_mask': bench_top_k_mask, 'rewire_module': bench_rewire_module,
+              'rewire_workers': bench_rewire_workers,
+              'momentum_redistribution': bench_momentum_redistribution,
+              'erdos_renyi_sparsity': bench_erdos_renyi_sparsity}
+
+# Cell
+def import_time(module, n_iter=5):
+    '''Returns the median time (in seconds) to import `module` in a new Python process.'''
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    times = [float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+             for _ in range(n_iter)]
+    return float(np.median(times))
+
+def bench_import(modules=('fastsparse', 'fastsparse.base', 'fastsparse.core'), n_iter=5):
+    return [dict(module=m, time=import_time(m, n_iter), peak_mem=None) for m in modules]
+
+# Cell
+def run_benchmarks(widths=(256, 1024), depths=(2, 8), sparsities=(0.5, 0.9, 0.99, 0.999), names=None,
+                   n_iter=10, device='cpu', verbose=False):
+    '''
+    Runs the benchmarks in `names` (default: all) over the grid of model sizes and sparsities and returns a dict of
+    results. Benchmark 'import' measures the import times of fastsparse modules.
+    '''
+    results = []
+    names = names or ['import'] + list(benchmarks)
+    if 'import' in names:
+        for r in bench_import(n_iter=n_iter):
+            results.append(dict(name='import', **r))
+            if verbose: print(_fmt_result(results[-1]))
+    for name in names:
+        if name == 'import': continue
+        for width in widths:
+            for depth in depths:
+                for sparsity in sparsities:
+                    res = benchmarks[name](width, depth, sparsity, n_iter=n_iter, device=device)
+                    for r in (res if isinstance(res, list) else [res]):
+                        results.append(dict(name=name, width=width, depth=depth, sparsity=sparsity, **r))
+                        if verbose: print(_fmt_result(results[-1]))
+    meta = dict(torch=torch.__version__, python=platform.python_version(), machine=platform.machine(),
+                device=str(device), n_threads=torch.get_num_threads(), n_iter=n_iter)
+    return dict(meta=meta, results=results)
+
+_result_keys = ('name', 'module', 'width', 'depth', 'sparsity', 'enforce_mask', 'rewire_workers', 'sparse_grad')
+
+def _result_key(r): return tuple(r.get(k) for k in _result_keys)
+
+def _fmt_result(r):
+    key = ' '.join(f'{k}={r[k]}' for k in _result_keys if r.get(k) is not None)
+    mem = 'n/a' if r['peak_mem'] is None else f"{r['peak_mem'] / 2**20:.1f}MB"
+    return f"{key}: {r['time'] * 1e3:.3f}ms, peak mem {mem}"
+
+def save_benchmarks(results, fn):
+    with open(fn, 'w') as f: json.dump(results, f, indent=1)
+
+def load_benchmarks(fn):
+    with open(fn) as f: return json.load(f)
+
+def compare_benchmarks(baseline, results, time_tol=0.25, mem_tol=0.25, min_time=1e-4, min_mem=2**20):
+    '''
+    Returns a list of regressions of `results` compared to `baseline`: benchmarks that are more than `time_tol`
+    slower, or use more than `mem_tol` more peak memory. Differences below `min_time` seconds or `min_mem` bytes
+    are considered noise.
+    '''
+    base_d = {_result_key(r): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        base = base_d.get(_result_key(r))
+        if base is None: continue
+        for k, tol, min_diff in [('time', time_tol, min_time), ('peak_mem', mem_tol, min_mem)]:
+            if r[k] is None or base[k] is None: continue
+            if r[k] > base[k] * (1 + tol) and r[k] - base[k] > min_diff:
+                regressions.append(dict(key=_result_key(r), metric=k, baseline=base[k], value=r[k],
+                                        ratio=r[k] / max(base[k], 1e-12)))
+    return regressions
+
+# Cell
+def _ints(s): return [int(o) for o in s.split(',')]
+def _floats(s): return [float(o) for o in s.split(',')]
+
+@call_parse
+def benchmark_cli(
+    out:str='benchmark.json', # JSON file to write the results to
+    widths:str='256,1024', # comma-separated model widths
+    depths:str='2,8', # comma-separated model depths
+    sparsities:str='0.5,0.9,0.99,0.999', # comma-separated sparsities
+    names:str=None, # comma-separated benchmarks to run (default: all)
+    n_iter:int=10, # number of timed calls per benchmark
+    device:str='cpu', # device to run the benchmarks on
+):
+    "Runs the fastsparse benchmarks and saves the results."
+    results = run_benchmarks(_ints(widths), _ints(depths), _floats(sparsities), names.split(',') if names else None,
+                             n_iter=n_iter, device=device, verbose=True)
+    save_benchmarks(results, out)
+
+@call_parse
+def compare_cli(
+    baseline:str, # JSON file with baseline results
+    results:str, # JSON file with results to compare
+    time_tol:float=0.25, # flag benchmarks that are slower by more than this fraction
+    mem_tol:float=0.25, # flag benchmarks that use more peak memory by more than this fraction
+):
+    "Compares two benchmark results files and exits with status 1 if there are regressions."
+    regressions = compare_benchmarks(load_benchmarks(baseline), load_benchmarks(results), time_tol, mem_tol)
+    for r in regressions:
+        key = ' '.join(f'{k}={v}' for k, v in zip(_result_keys, r['key']) if v is not None)
+        print(f"REGRESSION {key}: {r['metric']} {r['baseline']:.4g} -> {r['value']:.4g} ({r['ratio']:.2f}x)")
+    if regressions: raise SystemExit(1)
+    print('No regressions')
\ No newline at end of file
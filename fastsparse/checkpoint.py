@@ -0,0 +1,242 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 01_checkpoint.ipynb (unless otherwise specified).
+
+__all__ = ['save_sparse_model', 'load_sparse_model', 'MaskHistoryWriter', 'MaskHistory']
+
+# Cell
+import os
+import json
+import struct
+import bisect
+import numpy as np
+import torch
+from .base import *
+
+# Cell
+def _key(module_name, name): return f'{module_name}.{name}' if module_name else name
+
+def _masked_params(model):
+    '''Yields (state dict key, module, param name, param, mask) for each masked parameter in `model`.'''
+    for mn, m in model.named_modules():
+        buffer_d = dict(m.named_buffers(recurse=False))
+        for pn, p in m.named_parameters(recurse=False):
+            if f'{pn}_mask' in buffer_d: yield _key(mn, pn), m, pn, p, buffer_d[f'{pn}_mask']
+
+def _mask_encoding(mask):
+    '''Index encoding (4 bytes per active connection) is smaller than bits (1/8 byte per weight) below 1/32 density.'''
+    n_ones, n_total = int(mask.sum()), mask.numel()
+    return 'index' if 32 * n_ones < n_total and n_total < 2**31 else 'bits'
+
+# Cell
+@torch.no_grad()
+def save_sparse_model(file, model, encoding=None):
+    '''
+    Saves the state dict of `model`, storing only the active connections of each masked parameter.
+
+    `encoding`: how masks are stored, one of [None, 'bits', 'index']. If None, the smaller of the two is
+    chosen separately for each parameter.
+    '''
+    sparse_d, skip_keys = {}, set()
+    for key, m, pn, p, mask in _masked_params(model):
+        enc = _mask_encoding(mask) if encoding is None else encoding
+        if enc == 'index': mask_data = mask.reshape(-1).nonzero().squeeze(1).int()
+        elif enc == 'bits': mask_data = pack_mask(mask)
+        else: raise ValueError(f"Unknown mask encoding: {enc}. Possible values: [None, 'bits', 'index']")
+        sparse_d[key] = {'sizes': list(p.shape), 'encoding': enc, 'structure': getattr(m, f'{pn}_mask_structure', None),
+                         'mask': mask_data.cpu(), 'values': p.masked_select(mask).cpu()}
+        skip_keys |= {key, f'{key}_mask'}
+    dense_d = {k:v for k,v in model.state_dict().items() if k not in skip_keys}
+    torch.save({'dense': dense_d, 'sparse': sparse_d}, file)
+
+# Cell
+def _decode_mask(d, device):
+    sizes = d['sizes']
+    if d['encoding'] == 'index':
+        mask = torch.zeros(int(np.prod(sizes)), dtype=torch.bool, device=device)
+        mask[d['mask'].to(device).long()] = True
+        return mask.view(*sizes)
+    return unpack_mask(d['mask'].to(device), sizes)
+
+def _set_buffer(m, name, t):
+    '''Updates buffer `name` of module `m` in place if it exists, otherwise registers it.'''
+    if getattr(m, name, None) is not None: getattr(m, name).data = t
+    else: m.register_buffer(name, t)
+
+@torch.no_grad()
+def load_sparse_model(file, model, strict=True, mmap=False):
+    '''
+    Loads a checkpoint saved with `save_sparse_model` into `model`, adding mask & sparsity buffers where needed, and
+    restoring the structure of structured masks.
+    '''
+    state = torch.load(file, map_location='cpu', mmap=mmap, weights_only=True)
+    modules = dict(model.named_modules())
+    own_d = model.state_dict()
+    loaded_keys, unexpected_keys = set(), []
+    for key, d in state['sparse'].items():
+        mn, _, pn = key.rpartition('.')
+        if mn not in modules or not hasattr(modules[mn], pn):
+            unexpected_keys.append(key)
+            continue
+        m, p = modules[mn], getattr(modules[mn], pn)
+        mask = _decode_mask(d, p.device)
+        _set_buffer(m, f'{pn}_mask', mask)
+        if 'structure' in d:
+            structure = d['structure']
+            setattr(m, f'{pn}_mask_structure', tuple(structure) if isinstance(structure, list) else structure)
+        p.data.zero_().masked_scatter_(mask, d['values'].to(p.device, p.dtype))
+        loaded_keys |= {key, f'{key}_mask'}
+    for key, v in state['dense'].items():
+        mn, _, name = key.rpartition('.')
+        if key in own_d: own_d[key].copy_(v)
+        elif name.endswith('_sparsity') and mn in modules: _set_buffer(modules[mn], name, v.clone())
+        else:
+            unexpected_keys.append(key)
+            continue
+        loaded_keys.add(key)
+    clear_sparse_params_cache(model)
+    missing_keys = [k for k in own_d if k not in loaded_keys]
+    if strict and (missing_keys or unexpected_keys):
+        raise RuntimeError(f'Error(s) in loading sparse checkpoint for {model.__class__.__name__}: '
+                           f'missing keys: {missing_keys}, unexpected keys: {unexpected_keys}')
+
+# Cell
+_mask_log_magic = b'FSMASKLOG1'
+# record header: kind (b'P': parameter, b'K': full mask, b'D': dropped & grown indices), step, parameter id, payload size
+_record_header = struct.Struct('<cIIQ')
+_delta_header = struct.Struct('<QQQ')
+
+def _varint_encode(x):
+    '''Encodes the non-negative integers `x` as LEB128 varints, 7 bits per byte.'''
+    x = np.asarray(x, dtype=np.uint64)
+    n_bytes, rest = np.ones(len(x), dtype=np.int64), x >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    starts, out = np.cumsum(n_bytes) - n_bytes, np.empty(int(n_bytes.sum()), dtype=np.uint8)
+    for k in range(int(n_bytes.max(initial=0))):
+        sel = n_bytes > k
+        byte = (x[sel] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        out[starts[sel] + k] = byte | np.where(n_bytes[sel] > k + 1, 0x80, 0).astype(np.uint64)
+    return out.tobytes()
+
+def _varint_decode(b):
+    '''Inverse of `_varint_encode`, returns a uint64 array.'''
+    b = np.frombuffer(b, dtype=np.uint8)
+    if len(b) == 0: return np.zeros(0, dtype=np.uint64)
+    ends = np.flatnonzero(b < 0x80)
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    shifts = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)).astype(np.uint64) * np.uint64(7)
+    return np.bitwise_or.reduceat((b & 0x7f).astype(np.uint64) << shifts, starts)
+
+def _encode_indices(idx):
+    '''Encodes sorted flat indices as varints of their differences.'''
+    return _varint_encode(np.diff(idx.cpu().numpy().astype(np.uint64), prepend=np.uint64(0)))
+
+def _decode_indices(b): return torch.from_numpy(np.cumsum(_varint_decode(b)).astype(np.int64))
+
+# Cell
+class MaskHistoryWriter:
+    '''
+    Appends the connectivity updates of a `DynamicSparseTrainingCallback` to `file`, see above. If `file` exists,
+    records are appended after its last update step, e.g. when resuming training.
+    '''
+    def __init__(self, file, keyframe_every=100):
+        self.file, self.keyframe_every, self.ids, self.step = file, keyframe_every, {}, 0
+        if os.path.exists(file) and os.path.getsize(file) > 0:
+            history = MaskHistory(file)
+            self.ids, self.step = {name: i for i, name in enumerate(history.names)}, history.n_steps
+            history.close()
+            self.f = open(file, 'ab')
+        else:
+            self.f = open(file, 'wb')
+            self.f.write(_mask_log_magic)
+
+    def _write(self, kind, pid, payload, step=None):
+        self.f.write(_record_header.pack(kind, self.step + 1 if step is None else step, pid, len(payload)))
+        self.f.write(payload)
+
+    @torch.no_grad()
+    def append(self, name, old_mask, new_mask):
+        '''Records the update of the mask of parameter `name` from `old_mask` to `new_mask` in the current update step.'''
+        if name not in self.ids:
+            self.ids[name] = pid = len(self.ids)
+            self._write(b'P', pid, json.dumps(dict(name=name, shape=list(new_mask.shape))).encode(), step=self.step)
+            self._write(b'K', pid, pack_mask(old_mask).cpu().numpy().tobytes(), step=self.step)
+        pid = self.ids[name]
+        if (self.step + 1) % self.keyframe_every == 0:
+            return self._write(b'K', pid, pack_mask(new_mask).cpu().numpy().tobytes())
+        old_mask, new_mask = old_mask.reshape(-1), new_mask.reshape(-1)
+        dropped = (old_mask & new_mask.logical_not()).nonzero().squeeze(1)
+        grown = (new_mask & old_mask.logical_not()).nonzero().squeeze(1)
+        payload = _encode_indices(dropped)
+        header = _delta_header.pack(len(dropped), len(grown), len(payload))
+        self._write(b'D', pid, header + payload + _encode_indices(grown))
+
+    def commit(self):
+        '''Ends the current update step, flushing its records to disk.'''
+        self.step += 1
+        self.f.flush()
+
+    def close(self): self.f.close()
+    def __enter__(self): return self
+    def __exit__(self, *args): self.close()
+
+# Cell
+class MaskHistory:
+    '''Memory-maps a log written by `MaskHistoryWriter`, giving random access to the masks after each update step.'''
+    def __init__(self, file):
+        self.data = np.memmap(file, dtype=np.uint8, mode='r')
+        if bytes(self.data[:len(_mask_log_magic)]) != _mask_log_magic: raise ValueError(f'{file} is not a mask history log')
+        # only the record headers are read, to index the records of each parameter
+        self.names, self.shapes, self.n_steps, self._records, self._keyframes = [], [], 0, [], []
+        offset, size = len(_mask_log_magic), len(self.data)
+        while offset + _record_header.size <= size:
+            kind, step, pid, n = _record_header.unpack_from(self.data, offset)
+            offset += _record_header.size
+            if offset + n > size: break # incomplete record of an update that wasn't committed
+            if kind == b'P':
+                d = json.loads(bytes(self.data[offset:offset + n]))
+                self.names.append(d['name'])
+                self.shapes.append(tuple(d['shape']))
+                self._records.append([])
+                self._keyframes.append([])
+            else:
+                if kind == b'K': self._keyframes[pid].append(len(self._records[pid]))
+                self._records[pid].append((step, kind, offset, n))
+                self.n_steps = max(self.n_steps, step)
+            offset += n
+        self._ids = {name: i for i, name in enumerate(self.names)}
+
+    def _payload(self, offset, n): return self.data[offset:offset + n].tobytes()
+
+    def _delta(self, offset, n):
+        n_dropped, n_grown, n_dropped_bytes = _delta_header.unpack_from(self.data, offset)
+        start = offset + _delta_header.size
+        return (_decode_indices(self._payload(start, n_dropped_bytes)),
+                _decode_indices(self._payload(start + n_dropped_bytes, n - _delta_header.size - n_dropped_bytes)))
+
+    def mask(self, name, step=None):
+        '''Returns the mask of parameter `name` after update `step` (default: the last one).'''
+        pid = self._ids[name]
+        records, step = self._records[pid], self.n_steps if step is None else step
+        steps = [records[i][0] for i in self._keyframes[pid]]
+        k = bisect.bisect_right(steps, step) - 1
+        if k < 0: raise ValueError(f'No mask of {name} at step {step}, its first step is {steps[0]}')
+        i = self._keyframes[pid][k]
+        mask = unpack_mask(torch.frombuffer(bytearray(self._payload(*records[i][2:])), dtype=torch.uint8), self.shapes[pid])
+        mask = mask.clone().reshape(-1)
+        for s, kind, offset, n in records[i + 1:]:
+            if s > step: break
+            dropped, grown = self._delta(offset, n)
+            mask[dropped], mask[grown] = False, True
+        return mask.view(*self.shapes[pid])
+
+    def masks(self, step=None):
+        '''Returns a dict of the masks of all parameters after update `step` (default: the last one).'''
+        return {name: self.mask(name, step) for name in self.names}
+
+    def changes(self, name, step):
+        '''Returns the flat indices of the connections of parameter `name` dropped and grown by update `step`.'''
+        prev, mask = self.mask(name, step - 1).reshape(-1), self.mask(name, step).reshape(-1)
+        return (prev & mask.logical_not()).nonzero().squeeze(1), (mask & prev.logical_not()).nonzero().squeeze(1)
+
+    def close(self): self.data = None
\ No newline at end of file
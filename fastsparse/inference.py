@@ -0,0 +1,276 @@
+# AUTOGENERATED! DO NOT EDIT! File to edit: 02_inference.ipynb (unless otherwise specified).
+
+__all__ = ['SparseLinear', 'SparseConv2d', 'to_sparse_inference', 'compact_model']
+
+# Cell
+import copy
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.modules.utils import _single, _pair
+from .base import *
+
+# Cell
+def _to_sparse(t, layout):
+    if layout == torch.sparse_csr: return t.to_sparse_csr()
+    if layout == torch.sparse_coo: return t.to_sparse().coalesce()
+    raise ValueError(f'Unsupported layout: {layout}. Possible values: [torch.sparse_csr, torch.sparse_coo]')
+
+class SparseLinear(nn.Module):
+    '''Inference-only equivalent of a masked `nn.Linear` backed by a sparse weight matrix.'''
+    def __init__(self, weight, bias=None, layout=torch.sparse_csr):
+        super().__init__()
+        self.in_features, self.out_features = weight.shape[1], weight.shape[0]
+        self.register_buffer('weight', _to_sparse(weight.detach(), layout))
+        self.register_buffer('bias', None if bias is None else bias.detach().clone())
+
+    @classmethod
+    def from_dense(cls, m, layout=torch.sparse_csr):
+        mask = getattr(m, 'weight_mask', None)
+        weight = m.weight if mask is None else m.weight * mask
+        return cls(weight, m.bias, layout=layout)
+
+    def forward(self, x):
+        x2d = x.reshape(-1, self.in_features)
+        out = torch.sparse.mm(self.weight, x2d.t()).t()
+        if self.bias is not None: out = out + self.bias
+        return out.reshape(*x.shape[:-1], self.out_features)
+
+    def extra_repr(self):
+        return f'in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}'
+
+# Cell
+class SparseConv2d(nn.Module):
+    '''Inference-only equivalent of a masked `nn.Conv1d` or `nn.Conv2d` using im2col + a sparse weight matrix.'''
+    def __init__(self, weight, bias=None, stride=1, padding=0, dilation=1, layout=torch.sparse_csr):
+        super().__init__()
+        self.is_1d = weight.dim() == 3
+        if self.is_1d:
+            weight = weight.unsqueeze(2)
+            stride, padding, dilation = (1, *_single(stride)), (0, *_single(padding)), (1, *_single(dilation))
+        self.out_channels, self.kernel_size = weight.shape[0], weight.shape[2:]
+        self.unfold_kwargs = {k: _pair(v) for k, v in dict(stride=stride, padding=padding, dilation=dilation).items()}
+        self.register_buffer('weight', _to_sparse(weight.detach().reshape(self.out_channels, -1), layout))
+        self.register_buffer('bias', None if bias is None else bias.detach().clone())
+
+    @classmethod
+    def from_dense(cls, m, layout=torch.sparse_csr):
+        mask = getattr(m, 'weight_mask', None)
+        weight = m.weight if mask is None else m.weight * mask
+        return cls(weight, m.bias, stride=m.stride, padding=m.padding, dilation=m.dilation, layout=layout)
+
+    def forward(self, x):
+        if self.is_1d: x = x.unsqueeze(2)
+        bs, (h, w) = x.shape[0], x.shape[2:]
+        kwargs = self.unfold_kwargs
+        out_hw = [(size + 2*p - d*(k-1) - 1) // s + 1 for size, k, s, p, d in
+                  zip((h, w), self.kernel_size, kwargs['stride'], kwargs['padding'], kwargs['dilation'])]
+        cols = F.unfold(x, self.kernel_size, **kwargs)           # (bs, c*kh*kw, L)
+        cols = cols.transpose(0, 1).reshape(cols.shape[1], -1)   # (c*kh*kw, bs*L)
+        out = torch.sparse.mm(self.weight, cols)                 # (out_channels, bs*L)
+        if self.bias is not None: out = out + self.bias.unsqueeze(1)
+        out = out.reshape(self.out_channels, bs, *out_hw).transpose(0, 1)
+        return out.squeeze(2) if self.is_1d else out
+
+    def extra_repr(self):
+        return f'out_channels={self.out_channels}, kernel_size={tuple(self.kernel_size)}, ' + \
+               ', '.join(f'{k}={v}' for k, v in self.unfold_kwargs.items())
+
+# Cell
+def _is_convertible(m):
+    if not hasattr(m, 'weight_mask'): return False
+    if isinstance(m, nn.Linear): return True
+    if isinstance(m, (nn.Conv1d, nn.Conv2d)):
+        return m.groups == 1 and m.padding_mode == 'zeros' and not isinstance(m.padding, str)
+    return False
+
+def _sparse_module(m, layout):
+    f = SparseLinear if isinstance(m, nn.Linear) else SparseConv2d
+    return f.from_dense(m, layout=layout)
+
+@torch.no_grad()
+def _time_module(m, x, n_iter):
+    m(x) # warm up
+    times = []
+    for _ in range(n_iter):
+        start = time.perf_counter()
+        m(x)
+        times.append(time.perf_counter() - start)
+    return float(np.median(times))
+
+@torch.no_grad()
+def _module_inputs(model, modules, xb):
+    '''Returns the input each module in `modules` receives when `model(xb)` is run.'''
+    inputs = {}
+    def hook(m, i): inputs[m] = i[0].detach()
+    handles = [m.register_forward_pre_hook(hook) for m in modules]
+    try: model(xb)
+    finally:
+        for h in handles: h.remove()
+    return inputs
+
+# Cell
+@torch.no_grad()
+def to_sparse_inference(model, xb=None, layout=torch.sparse_csr, min_speedup=1., n_iter=10, verbose=False):
+    '''
+    Replaces masked `nn.Linear`, `nn.Conv1d` and `nn.Conv2d` layers of `model` with sparse-kernel modules, in place.
+
+    `xb`: sample input used to benchmark each layer, which is only replaced when its sparse
+    equivalent is at least `min_speedup` times faster. If None, all supported layers are replaced.
+
+    Returns `model` in eval mode.
+    '''
+    model.eval()
+    modules = [m for m in sparseable_modules(model) if _is_convertible(m)]
+    inputs = {} if xb is None else _module_inputs(model, modules, xb)
+    parents = {c: (parent, name) for parent in model.modules() for name, c in parent.named_children()}
+    for m in modules:
+        if m not in parents: continue
+        sparse_m = _sparse_module(m, layout)
+        if m in inputs:
+            dense_t, sparse_t = _time_module(m, inputs[m], n_iter), _time_module(sparse_m, inputs[m], n_iter)
+            if verbose: print(f'{m}: dense {dense_t*1e3:.3f}ms, sparse {sparse_t*1e3:.3f}ms')
+            if dense_t < sparse_t * min_speedup: continue
+        elif xb is not None: continue # layer was not used for `xb`
+        parent, name = parents[m]
+        setattr(parent, name, sparse_m)
+    return model
+
+# Cell
+_bn_types = (nn.BatchNorm1d, nn.BatchNorm2d, nn.BatchNorm3d)
+# modules acting on each unit independently that map constant inputs to constant outputs...
+_constant_types = _bn_types + (nn.Identity, nn.Flatten, nn.Dropout, nn.Dropout1d, nn.Dropout2d, nn.Dropout3d, nn.AlphaDropout,
+                               nn.ReLU, nn.ReLU6, nn.LeakyReLU, nn.PReLU, nn.ELU, nn.SELU, nn.CELU, nn.GELU, nn.SiLU, nn.Mish,
+                               nn.Hardswish, nn.Hardsigmoid, nn.Hardtanh, nn.Sigmoid, nn.Tanh, nn.Softplus)
+# adaptive pools output the constant of each unit at every output position, whatever the output size
+_adaptive_pool_types = (nn.AdaptiveAvgPool1d, nn.AdaptiveAvgPool2d, nn.AdaptiveAvgPool3d,
+                        nn.AdaptiveMaxPool1d, nn.AdaptiveMaxPool2d, nn.AdaptiveMaxPool3d)
+_constant_types += _adaptive_pool_types
+# ... and those that only map zero inputs to zero outputs
+_zero_types = (nn.MaxPool1d, nn.MaxPool2d, nn.MaxPool3d, nn.AvgPool1d, nn.AvgPool2d, nn.AvgPool3d)
+
+def _is_unit_layer(m):
+    return isinstance(m, (nn.Linear, nn.Conv1d, nn.Conv2d, nn.Conv3d)) and getattr(m, 'groups', 1) == 1
+
+def _has_padding(m):
+    if isinstance(m, nn.Linear): return False
+    return m.padding != 'valid' if isinstance(m.padding, str) else any(m.padding)
+
+def _sequential_leaves(seq):
+    for c in seq.children():
+        if isinstance(c, nn.Sequential): yield from _sequential_leaves(c)
+        else: yield c
+
+def _compactable_chains(model):
+    '''Returns the lists [producer, *modules in between, consumer] of layers that units can be removed from.'''
+    nested = {id(c) for m in model.modules() if isinstance(m, nn.Sequential) for c in m.children()}
+    chains = []
+    for seq in model.modules():
+        if not isinstance(seq, nn.Sequential) or id(seq) in nested: continue
+        leaves = list(_sequential_leaves(seq))
+        for i, m in enumerate(leaves):
+            if not _is_unit_layer(m): continue
+            j = i + 1
+            while j < len(leaves) and isinstance(leaves[j], _constant_types + _zero_types): j += 1
+            if j < len(leaves) and _is_unit_layer(leaves[j]): chains.append(leaves[i:j + 1])
+    return chains
+
+def _active(m): return m.weight_mask if hasattr(m, 'weight_mask') else m.weight.ne(0)
+
+def _keep(t, keep, dim=0): t.data = t.data.index_select(dim, keep.nonzero().view(-1))
+
+@torch.no_grad()
+def _compact_chain(chain):
+    '''Removes the dead units between the first and the last layer of `chain`, returns the number of units removed.'''
+    p, between, c = chain[0], chain[1:-1], chain[-1]
+    n, flatten = p.weight.shape[0], any(isinstance(m, nn.Flatten) for m in between)
+    # the consumer's weights for each unit: (out, n, # weights per unit)
+    if isinstance(c, nn.Linear):
+        if c.in_features % n or (not flatten and (c.in_features != n or not isinstance(p, nn.Linear))): return 0
+    elif flatten or isinstance(p, nn.Linear) or c.in_channels != n: return 0
+    if any(isinstance(m, _bn_types) and (m.num_features != n or m.running_mean is None) for m in between): return 0
+    if any(isinstance(m, nn.PReLU) and m.num_parameters not in (1, n) for m in between): return 0
+    c_active = _active(c).reshape(c.weight.shape[0], n, -1)
+    dead_in, dead_out = c_active.any(2).any(0).logical_not(), _active(p).reshape(n, -1).any(1).logical_not()
+
+    # output of the producer's dead units, through the modules in between
+    x = (p.bias.detach().clone() if p.bias is not None else p.weight.new_zeros(n)).view(1, n, *[1] * (p.weight.dim() - 2))
+    foldable = torch.ones(n, dtype=torch.bool, device=x.device)
+    for m in between:
+        # the constant of each unit is kept at a single position: after a flatten, the consumer's columns of each
+        # unit (one per position) are contiguous, and they are all folded with the same constant
+        if isinstance(m, nn.Flatten): x = x.reshape(1, n)
+        elif isinstance(m, _adaptive_pool_types): continue
+        elif isinstance(m, _zero_types): foldable &= x.reshape(n).eq(0)
+        else: x = m(x)
+    const = x.reshape(n)
+    if _has_padding(c): foldable &= const.eq(0)
+
+    remove = dead_in | (dead_out & foldable)
+    if remove.all(): remove[0] = False # keep one unit, so that all layers keep valid shapes
+    if not remove.any(): return 0
+    fold = remove & dead_out & dead_in.logical_not()
+    if fold.any():
+        c_weight = (c.weight * _active(c)).reshape(c.weight.shape[0], n, -1)
+        if c.bias is None: c.bias = nn.Parameter(c.weight.new_zeros(c.weight.shape[0]))
+        c.bias.data += (c_weight * (const * fold).view(1, n, 1)).sum((1, 2))
+
+    # remove the units, keeping the identity of all tensors (e.g. referenced by mask hooks)
+    keep = remove.logical_not()
+    for t in [p.weight, p.bias, getattr(p, 'weight_mask', None)]:
+        if t is not None: _keep(t, keep)
+    for m in between:
+        for t in [getattr(m, k, None) for k in ['weight', 'bias', 'running_mean', 'running_var']]:
+            if t is not None and t.numel() == n: _keep(t, keep)
+        if isinstance(m, _bn_types): m.num_features = int(keep.sum())
+        if isinstance(m, nn.PReLU): m.num_parameters = m.weight.numel()
+    c_keep = keep.repeat_interleave(c_active.shape[2]) if isinstance(c, nn.Linear) else keep
+    for t in [c.weight, getattr(c, 'weight_mask', None)]:
+        if t is not None: _keep(t, c_keep, dim=1)
+    for m in [p, c]:
+        if isinstance(m, nn.Linear): m.in_features, m.out_features = m.weight.shape[1], m.weight.shape[0]
+        else: m.in_channels, m.out_channels = m.weight.shape[1], m.weight.shape[0]
+    for m in [p, c]:
+        if hasattr(m, 'weight_sparsity'): m.weight_sparsity.fill_(1 - m.weight_mask.float().mean())
+        m.__dict__.pop('_flops_cache', None)
+    return int(remove.sum())
+
+def _n_params(model): return sum(p.numel() for p in model.parameters())
+
+# Cell
+@torch.no_grad()
+def compact_model(model, xb=None, inplace=False, verbose=False):
+    '''
+    Removes the dead units (neurons and channels without active weights) of the layers of `model`, see above.
+
+    `xb`: sample input to count the FLOPs of the model before and after compaction with `count_flops`.
+
+    Returns the compacted model (a copy of `model`, unless `inplace`) in eval mode, and a dict with the number of
+    parameters, dense and sparse FLOPs (if `xb`) before and after compaction, and the number of units removed after
+    each layer, by module name.
+    '''
+    if not inplace: model = copy.deepcopy(model)
+    model.eval()
+    for m in sparseable_modules(model): apply_masks(m)
+    flops = lambda: (count_flops(model, xb), count_flops(model, xb, sparse=True)) if xb is not None else (None, None)
+    n_params, (n_flops, n_sparse_flops) = _n_params(model), flops()
+
+    names, removed = {m: name for name, m in model.named_modules()}, {}
+    chains, n_removed = _compactable_chains(model), 1
+    while n_removed > 0:
+        n_removed = 0
+        for chain in chains:
+            n = _compact_chain(chain)
+            if n: removed[names[chain[0]]] = removed.get(names[chain[0]], 0) + n
+            n_removed += n
+    clear_sparse_params_cache(model)
+
+    n_flops_after, n_sparse_flops_after = flops()
+    report = dict(n_params=(n_params, _n_params(model)), flops=(n_flops, n_flops_after),
+                  sparse_flops=(n_sparse_flops, n_sparse_flops_after), removed=removed)
+    if verbose:
+        print(f"parameters: {n_params:,} -> {report['n_params'][1]:,}" +
+              (f", FLOPs: {n_flops:,} -> {report['flops'][1]:,}" if xb is not None else '') + f', units removed: {removed}')
+    return model, report
\ No newline at end of file